@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib import sha256
+from os import cpu_count, utime
+from pathlib import Path
+from shutil import copyfile
+from subprocess import run
+from threading import Condition
+from timeit import default_timer as timer
+
+# one more thread for every THREAD_COST of estimated cost
+THREAD_COST = 1e9
+log = logging.getLogger(__name__)
+
+
+class AlignJob:
+    """
+    One mafft run, output is the stdout of mafft.
+    If ref is given, add sequences in fasta to ref alignment (--add).
+    """
+    def __init__(self, fasta, out, options=('--auto', ), ref=None):
+        self.fasta = Path(fasta)
+        self.out = Path(out)
+        self.options = list(options)
+        self.ref = None if ref is None else Path(ref)
+        self.cost = 0
+        self.threads = 1
+        self.seconds = 0.0
+        self.returncode = None
+        self.cached = False
+        self.key = None
+
+    def __str__(self):
+        return self.fasta.name
+
+    def command(self, threads):
+        cmd = ['mafft', '--thread', str(threads), *self.options]
+        if self.ref is not None:
+            cmd.extend(['--add', str(self.fasta), str(self.ref)])
+        else:
+            cmd.append(str(self.fasta))
+        return cmd
+
+
+class AlignCache:
+    """
+    Content-addressed cache of alignments.
+    Key is the hash of input fasta, reference alignment and mafft options,
+    thread number is not included. Oldest files are removed when total size
+    exceeds max_size (bytes).
+    """
+    def __init__(self, folder, max_size=10*1024**3):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.size = sum(i.stat().st_size for i in self.folder.glob('*/*.aln'))
+
+    @staticmethod
+    def get_key(job) -> str:
+        key = sha256()
+        for i in (job.fasta, job.ref):
+            if i is None:
+                key.update(b'\0none')
+                continue
+            key.update(b'\0file')
+            with open(i, 'rb') as raw:
+                for block in iter(lambda: raw.read(1 << 20), b''):
+                    key.update(block)
+        key.update('\0'.join(['options', *job.options]).encode())
+        return key.hexdigest()
+
+    def get_path(self, key) -> Path:
+        return self.folder / key[:2] / (key+'.aln')
+
+    def get(self, job) -> bool:
+        # copy cached alignment to job.out if found
+        job.key = self.get_key(job)
+        cached = self.get_path(job.key)
+        if not cached.exists():
+            return False
+        copyfile(cached, job.out)
+        # mark as recently used
+        utime(cached)
+        return True
+
+    def put(self, job):
+        if job.key is None:
+            job.key = self.get_key(job)
+        cached = self.get_path(job.key)
+        cached.parent.mkdir(exist_ok=True)
+        tmp = cached.with_suffix('.tmp')
+        copyfile(job.out, tmp)
+        if cached.exists():
+            self.size -= cached.stat().st_size
+        tmp.replace(cached)
+        self.size += cached.stat().st_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        files = sorted(self.folder.glob('*/*.aln'),
+                       key=lambda x: x.stat().st_mtime)
+        for old in files:
+            if self.size <= self.max_size:
+                break
+            self.size -= old.stat().st_size
+            old.unlink()
+            log.info(f'Remove old cache {old.name}.')
+
+
+class CoreBudget:
+    """
+    Cores shared by run_jobs calls running concurrently.
+    """
+    def __init__(self, cores=None):
+        if cores is None:
+            cores = max(1, cpu_count()-1)
+        self.cores = cores
+        self.free = cores
+        self.condition = Condition()
+
+    def try_acquire(self, n) -> bool:
+        with self.condition:
+            if n > self.free:
+                return False
+            self.free -= n
+            return True
+
+    def acquire(self, n):
+        with self.condition:
+            self.condition.wait_for(lambda: n <= self.free)
+            self.free -= n
+
+    def release(self, n):
+        with self.condition:
+            self.free += n
+            self.condition.notify_all()
+
+
+def estimate_cost(*files) -> int:
+    """
+    Estimate cost of alignment by number of sequences and total length.
+    Progressive alignment costs about n^2*mean_length, i.e. n*total_length.
+    """
+    n = 0
+    length = 0
+    for fasta in files:
+        with open(fasta, 'rb') as raw:
+            for line in raw:
+                if line.startswith(b'>'):
+                    n += 1
+                else:
+                    length += len(line.strip())
+    return n * length
+
+
+def get_threads(cost, max_threads) -> int:
+    return int(min(max_threads, max(1, cost // THREAD_COST)))
+
+
+def run_job(job):
+    start = timer()
+    try:
+        with open(job.out, 'wb') as out:
+            r = run(job.command(job.threads), stdout=out)
+        job.returncode = r.returncode
+    except OSError as e:
+        log.error(f'Cannot run mafft for {job}: {e}')
+        job.returncode = -1
+    job.seconds = timer() - start
+    if job.returncode != 0:
+        log.warning(f'{job} failed after {job.seconds:.1f}s.')
+    else:
+        log.info(f'{job} done with {job.threads} threads in '
+                 f'{job.seconds:.1f}s.')
+    return job
+
+
+def run_jobs(jobs, cores=None, max_threads=None, cache=None,
+             budget=None) -> list:
+    """
+    Run mafft jobs concurrently within the budget of cores.
+    Small jobs run in parallel with one thread each, large jobs get more
+    threads. Larger jobs are started first.
+    Jobs found in cache are copied instead of aligned.
+    Args:
+        jobs(list): AlignJob list
+        cores(int): total threads could be used, ignored if budget is given
+        max_threads(int): maximum threads of one job
+        cache(AlignCache): alignment cache
+        budget(CoreBudget): cores shared with other run_jobs calls
+    Return:
+        jobs(list): with returncode and seconds
+    """
+    if budget is None:
+        budget = CoreBudget(cores)
+    cores = budget.cores
+    if max_threads is None:
+        max_threads = cores
+    max_threads = min(max_threads, cores)
+    to_run = []
+    for job in jobs:
+        if cache is not None and cache.get(job):
+            job.cached = True
+            job.returncode = 0
+            log.info(f'{job} found in cache.')
+            continue
+        to_run.append(job)
+        inputs = [job.fasta] if job.ref is None else [job.fasta, job.ref]
+        job.cost = estimate_cost(*inputs)
+        job.threads = get_threads(job.cost, max_threads)
+    pending = sorted(to_run, key=lambda x: x.cost, reverse=True)
+    running = dict()
+    start = timer()
+    log.info(f'Run {len(to_run)} of {len(jobs)} alignments with {cores} '
+             f'threads.')
+    with ThreadPoolExecutor(cores) as executor:
+        while pending or running:
+            for job in list(pending):
+                if budget.try_acquire(job.threads):
+                    pending.remove(job)
+                    running[executor.submit(run_job, job)] = job
+            if not running:
+                # cores are used by others, wait for them
+                job = pending.pop(0)
+                budget.acquire(job.threads)
+                running[executor.submit(run_job, job)] = job
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                budget.release(job.threads)
+                future.result()
+                if cache is not None and job.returncode == 0:
+                    cache.put(job)
+    failed = [job for job in jobs if job.returncode != 0]
+    log.info(f'Finished {len(jobs)} alignments in {timer()-start:.1f}s, '
+             f'{len(failed)} failed.')
+    return jobs
@@ -1,11 +1,14 @@
 #!/usr/bin/python3
 
+from array import array
+from functools import partial
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 import argparse
 import logging
+import struct
 
 import numpy as np
-from Bio import SeqIO
 
 # define logger
 FMT = '%(asctime)s %(levelname)-8s %(message)s'
@@ -21,6 +24,17 @@ log_file.setFormatter(formatter)
 log_file.setLevel(default_level)
 log = logging.getLogger(__name__)
 
+# binary alignment: header, names joined by "\n", uint8 matrix (row-major)
+# header: magic, rows, columns, names size, matrix offset
+BIN_MAGIC = b'ALNUINT8'
+BIN_HEADER = struct.Struct('<8sQQQQ')
+BIN_SUFFIX = '.alnb'
+# align matrix offset to page size
+BIN_ALIGN = 4096
+# cells of alignment in one block of profile
+BLOCK_CELLS = 1 << 24
+GAP = ord('-')
+
 
 def init_arg(arg):
     if arg.input is None or len(arg.input)==0:
@@ -34,68 +48,169 @@ def parse_args():
     arg = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=main.__doc__)
-    arg.add_argument('-input', nargs='*', help='input alignment fasta')
+    arg.add_argument('-input', nargs='*',
+                     help='input alignment fasta or binary alignment')
     # 1.25 means if one seq's len is 1.25 fold than mean len, then it's too
     # long
-    arg.add_argument('-type', choices=('align', 'raw'), default='raw')
+    arg.add_argument('-type', choices=('align', 'raw', 'profile'),
+                     default='raw')
     arg.add_argument('-len_ratio', default=1.25, type=float,
                      help='length threshold')
+    arg.add_argument('-max_score', default=3.5, type=float,
+                     help='robust z-score threshold of profile')
     arg.add_argument('-out', help='output file')
+    arg.add_argument('-jobs', type=int, default=cpu_count(),
+                     help='number of processes for raw fasta files')
     return arg.parse_args()
 
 
+def index_fasta(aln_fasta: Path) -> tuple[list, list]:
+    """
+    Return:
+        names(list): bytes of names
+        lengths(list): sequence lengths
+    """
+    names = []
+    lengths = []
+    with open(aln_fasta, 'rb') as raw:
+        for line in raw:
+            if line.startswith(b'>'):
+                # remove ">" and CRLF
+                names.append(line[1:].strip())
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.strip())
+    return names, lengths
+
+
+def fill_array(aln_fasta: Path, sequence_array: np.array) -> np.array:
+    """
+    Write capital sequences into uint8 matrix (could be np.memmap).
+    """
+    row = -1
+    column = 0
+    with open(aln_fasta, 'rb') as raw:
+        for line in raw:
+            if line.startswith(b'>'):
+                row += 1
+                column = 0
+            elif row >= 0:
+                line = line.strip().upper()
+                sequence_array[row, column:column+len(line)] = np.frombuffer(
+                    line, dtype=np.uint8)
+                column += len(line)
+    return sequence_array
+
+
 def fasta_to_array(aln_fasta: Path) -> tuple[np.array, np.array]:
     """
     From BarcodeFinder.evaluate
     Given fasta format alignment filename, return a numpy array for sequence:
-    Faster and use smaller mem.
+    Read file twice, first for names and length, then write bytes of
+    sequences into preallocated uint8 matrix, to avoid python strings of
+    whole alignment.
     Ensure all bases are capital.
     Args:
         aln_fasta(Path): aligned fasta file
     Returns:
         name(np.array): name array
-        sequence(np.array): sequence array
+        sequence(np.array): sequence array, uint8, one row for each sequence
     """
-    data = []
-    record = ['id', 'sequence']
-    with open(aln_fasta, 'r', encoding='utf-8') as raw:
-        for line in raw:
-            if line.startswith('>'):
-                data.append([record[0], ''.join(record[1:])])
-                # remove ">" and CRLF
-                name = line[1:].strip()
-                record = [name, '']
-            else:
-                record.append(line.strip().upper())
-        # add last sequence
-        data.append([record[0], ''.join(record[1:])])
-    # skip head['id', 'seq']
-    data = data[1:]
+    names, lengths = index_fasta(aln_fasta)
     # check sequence length
-    length_check = [len(i[1]) for i in data]
-    if len(set(length_check)) != 1:
+    if len(set(lengths)) != 1:
         log.error(f'Invalid alignment file {aln_fasta}')
         return None, None
-    # Convert List to numpy array.
-    # order 'F' is a bit faster than 'C'
-    # new = np.hstack((name, seq)) -> is slower
-    name_array = np.array([[i[0]] for i in data], dtype=np.bytes_)
-    # fromiter is faster than from list
-    # S1: bytes
-    sequence_array = np.array(
-        [np.fromiter(i[1], dtype=np.dtype('S1')) for i in data],
-        order='F')
-    if name_array is None:
-        log.error('Bad fasta file {}.'.format(aln_fasta))
+    name_array = np.array([i.decode('utf-8') for i in names])
+    sequence_array = np.empty((len(names), lengths[0]), dtype=np.uint8)
+    fill_array(aln_fasta, sequence_array)
+    return name_array, sequence_array
+
+
+def fasta_to_bin(aln_fasta: Path, out=None) -> Path:
+    """
+    Convert fasta alignment to binary alignment.
+    The matrix is written through np.memmap, only one line of sequence is
+    kept in memory.
+    Args:
+        aln_fasta(Path): aligned fasta file
+        out(Path): output file, default is aln_fasta name + ".alnb"
+    Return:
+        out(Path): binary alignment, None if alignment is invalid
+    """
+    if out is None:
+        out = aln_fasta.with_name(aln_fasta.name+BIN_SUFFIX)
+    names, lengths = index_fasta(aln_fasta)
+    if len(set(lengths)) != 1:
+        log.error(f'Invalid alignment file {aln_fasta}')
+        return None
+    names_bytes = b'\n'.join(names)
+    rows, columns = len(names), lengths[0]
+    offset = BIN_HEADER.size + len(names_bytes)
+    offset += -offset % BIN_ALIGN
+    tmp = out.with_suffix(out.suffix+'.tmp')
+    with open(tmp, 'wb') as raw:
+        raw.write(BIN_HEADER.pack(BIN_MAGIC, rows, columns,
+                                  len(names_bytes), offset))
+        raw.write(names_bytes)
+        raw.truncate(offset+rows*columns)
+    if rows*columns != 0:
+        sequence_array = np.memmap(tmp, dtype=np.uint8, mode='r+',
+                                   offset=offset, shape=(rows, columns))
+        fill_array(aln_fasta, sequence_array)
+        sequence_array.flush()
+        del sequence_array
+    tmp.replace(out)
+    log.info(f'Write binary alignment {out}.')
+    return out
+
+
+def open_bin(aln_bin: Path) -> tuple[np.array, np.array]:
+    """
+    Open binary alignment with np.memmap, read-only.
+    Returns:
+        name(np.array): name array
+        sequence(np.array): sequence array, uint8 memmap
+    """
+    with open(aln_bin, 'rb') as raw:
+        magic, rows, columns, names_size, offset = BIN_HEADER.unpack(
+            raw.read(BIN_HEADER.size))
+        if magic != BIN_MAGIC:
+            raise ValueError(f'{aln_bin} is not a binary alignment.')
+        names_bytes = raw.read(names_size)
+    name_array = np.array(names_bytes.decode('utf-8').split('\n')
+                          if rows else [], dtype=str)
+    if rows*columns == 0:
+        return name_array, np.empty((rows, columns), dtype=np.uint8)
+    sequence_array = np.memmap(aln_bin, dtype=np.uint8, mode='r',
+                               offset=offset, shape=(rows, columns))
     return name_array, sequence_array
 
 
+def load_alignment(fasta: Path) -> tuple[np.array, np.array]:
+    """
+    Load binary alignment, convert fasta to binary alignment if it does
+    not exist or is older than fasta.
+    """
+    if fasta.suffix == BIN_SUFFIX:
+        return open_bin(fasta)
+    # g.fasta -> g.fasta.alnb, g.aln -> g.aln.alnb
+    aln_bin = fasta.with_name(fasta.name+BIN_SUFFIX)
+    if (not aln_bin.exists() or
+            aln_bin.stat().st_mtime_ns < fasta.stat().st_mtime_ns):
+        try:
+            aln_bin = fasta_to_bin(fasta)
+        except OSError as e:
+            log.warning(f'Cannot write binary alignment: {e}')
+            return fasta_to_array(fasta)
+        if aln_bin is None:
+            return None, None
+    return open_bin(aln_bin)
+
+
 def count_aln_len(fasta, threshold) -> tuple[np.array, np.array, float]:
-    name, seq = fasta_to_array(fasta)
-    # name is ndarray
-    name = name[:, 0]
-    name = np.array([i.decode() for i in name])
-    no_gap = (seq!=b'-')
+    name, seq = load_alignment(fasta)
+    no_gap = (seq!=ord('-'))
     count = np.count_nonzero(no_gap, axis=1)
     threshold = count.mean() * threshold
     too_long = (count>threshold)
@@ -104,12 +219,120 @@ def count_aln_len(fasta, threshold) -> tuple[np.array, np.array, float]:
     return count_array, too_long_array, threshold
 
 
-def count_len(fasta, threshold) -> tuple[dict, dict, float]:
-    data = SeqIO.to_dict(SeqIO.parse(fasta, 'fasta'))
-    name_len = {i: len(data[i]) for i in data}
-    threshold = np.mean(list(name_len.values())) * threshold
-    too_long = {i:name_len[i] for i in name_len if name_len[i]>threshold}
-    return name_len, too_long, threshold
+def get_blocks(seq, block_cells=None):
+    if block_cells is None:
+        block_cells = BLOCK_CELLS
+    rows, columns = seq.shape
+    step = max(1, block_cells // max(1, columns))
+    for start in range(0, rows, step):
+        yield start, np.asarray(seq[start:start+step])
+
+
+def get_runs(mask) -> tuple[np.array, np.array]:
+    """
+    Find runs of True in each row of 2d bool array.
+    Return:
+        row(np.array): row index of runs
+        length(np.array): length of runs
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1]+2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    diff = np.diff(padded, axis=1)
+    start_row, start = np.nonzero(diff == 1)
+    _, end = np.nonzero(diff == -1)
+    return start_row, end - start
+
+
+def profile_aln(fasta) -> dict:
+    """
+    Profile gaps of alignment, processed in blocks of rows.
+    Consensus of a column is gap if more than half of sequences are gap.
+    Insertion is the bases in columns of consensus gap.
+    Score is robust z-score of ungapped length: (x-median)/(1.4826*MAD).
+    Return:
+        profile(dict): name, gap_fraction (column), length, insertion,
+        insertion_runs, max_insertion (row) and score
+    """
+    name, seq = load_alignment(fasta)
+    rows, columns = seq.shape
+    gap_count = np.zeros(columns, dtype=np.int64)
+    length = np.zeros(rows, dtype=np.int64)
+    for start, block in get_blocks(seq):
+        gap = (block == GAP)
+        gap_count += np.count_nonzero(gap, axis=0)
+        length[start:start+len(block)] = columns - np.count_nonzero(gap,
+                                                                    axis=1)
+    gap_fraction = gap_count / max(1, rows)
+    consensus_gap = gap_fraction > 0.5
+    insertion = np.zeros(rows, dtype=np.int64)
+    insertion_runs = np.zeros(rows, dtype=np.int64)
+    max_insertion = np.zeros(rows, dtype=np.int64)
+    for start, block in get_blocks(seq):
+        inserted = (block != GAP) & consensus_gap
+        insertion[start:start+len(block)] = np.count_nonzero(inserted,
+                                                             axis=1)
+        run_row, run_len = get_runs(inserted)
+        np.add.at(insertion_runs, run_row+start, 1)
+        np.maximum.at(max_insertion, run_row+start, run_len)
+    if rows:
+        median = np.median(length)
+        mad = np.median(np.abs(length-median)) * 1.4826
+    else:
+        median, mad = 0, 0
+    # all lengths equal except outliers
+    if mad == 0:
+        mad = 1.0
+    score = (length-median) / mad
+    return dict(name=name, gap_fraction=gap_fraction, length=length,
+                insertion=insertion, insertion_runs=insertion_runs,
+                max_insertion=max_insertion, score=score)
+
+
+def count_len(fasta, threshold) -> tuple[list, np.array, float]:
+    """
+    Stream fasta file, only names and lengths are kept.
+    Name is the first word of the title line, like SeqIO.
+    Return:
+        names(list): names
+        lengths(np.array): sequence lengths
+        threshold(float): length threshold
+    """
+    # names joined by "\n"
+    names = bytearray()
+    lengths = array('q')
+    with open(fasta, 'rb') as raw:
+        for line in raw:
+            if line.startswith(b'>'):
+                title = line[1:].split(maxsplit=1)
+                names += (title[0] if title else b'') + b'\n'
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.translate(None, b' \t\r\n'))
+    names = names.decode('utf-8').split('\n')[:-1]
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    threshold = lengths.mean() * threshold
+    return names, lengths, threshold
+
+
+def write_len(fasta, threshold) -> tuple[Path, int, int]:
+    """
+    Count lengths of raw fasta and write csv and too_long files.
+    Return:
+        fasta(Path): input
+        n(int): number of sequences
+        n_too_long(int): number of too long sequences
+    """
+    names, lengths, threshold = count_len(fasta, threshold)
+    too_long = lengths > threshold
+    with open(fasta.with_suffix('.csv'), 'w') as out1:
+        out1.write('Name,Len\n')
+        for key, value in zip(names, lengths):
+            out1.write(f'{key},{value}\n')
+    with open(fasta.with_suffix('.too_long'), 'w') as out2:
+        out2.write('Name,Len\n')
+        for index in np.flatnonzero(too_long):
+            out2.write(f'{names[index]},{lengths[index]}\n')
+    return fasta, len(names), int(np.count_nonzero(too_long))
 
 
 def main():
@@ -128,18 +351,21 @@ def main():
                 np.savetxt(out1, count_array, delimiter=',', fmt='%s')
             with open(fasta.with_suffix('.too_long'), 'w') as out2:
                 np.savetxt(out2, too_long_array, delimiter=',', fmt='%s')
-    else:
+    elif arg.type == 'profile':
         for fasta in arg.input:
-            count_dict, too_long_dict, threshold = count_len(
-                fasta, arg.len_ratio)
-            with open(fasta.with_suffix('.csv'), 'w') as out1:
-                out1.write('Name,Len\n')
-                for key, value in count_dict.items():
-                    out1.write(f'{key},{value}\n')
-            with open(fasta.with_suffix('.too_long'), 'w') as out2:
-                out2.write('Name,Len\n')
-                for key, value in too_long_dict.items():
-                    out2.write(f'{key},{value}\n')
+            profile = profile_aln(fasta)
+            out = fasta.with_suffix('.profile.npz')
+            np.savez_compressed(out, **profile)
+            outlier = np.count_nonzero(profile['score'] > arg.max_score)
+            log.info(f'{fasta.name}: {outlier} of {len(profile["name"])} '
+                     f'sequences have score > {arg.max_score}.')
+    else:
+        jobs = min(arg.jobs, len(arg.input))
+        with Pool(max(1, jobs)) as pool:
+            for fasta, n, n_too_long in pool.imap(
+                    partial(write_len, threshold=arg.len_ratio), arg.input):
+                log.info(f'{fasta.name}: {n} sequences, {n_too_long} too '
+                         f'long.')
     log.info('Bye.')
 
 
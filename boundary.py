@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 
 import argparse
+import pickle
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 
+import numpy as np
 from Bio import SeqIO
 
 
@@ -13,37 +16,31 @@ def parse_args():
     # id, input, lenght, lsc, ir, ssc, ir
     arg.add_argument('-f', help='structure table file', required=True)
     arg.add_argument('-t', dest='threshold', type=int, default=10,
-                     help='overlap threshold')
+                     help='minimum overlap length of junction crossing')
     arg.add_argument('-o', default='out',
                      help='output directory')
+    arg.add_argument('-cache', default='boundary.cache',
+                     help='gene table cache file')
+    arg.add_argument('-jobs', type=int, default=cpu_count(),
+                     help='number of processes to read genbank files')
     return arg.parse_args()
 
 
-def compare_slice(a: slice, b: slice) -> tuple[str, int]:
-    # b broader than b
-    overlap_len = 0
-    relation = 'undefined'
-    if (a.start >= a.stop or b.start >= b.stop or
-            b.stop-b.start <= a.stop-a.start):
-        return relation, overlap_len
-    # a in b
-    if b.start <= a.start <= a.stop <= b.stop:
-        relation = 'in'
-    # a after b
-    elif b.start < b.stop <= a.start < a.stop:
-        relation = 'after'
-    # a before b
-    elif a.start < a.stop <= b.start < b.stop:
-        relation = 'before'
-    elif b.start < a.start < b.stop < a.stop:
-        overlap_len = b.stop - a.start
-        relation = 'overlap'
-    elif a.start < b.start < a.stop < b.stop:
-        overlap_len = a.stop - b.start
-        relation = 'overlap'
-    else:
-        pass
-    return relation, overlap_len
+REGIONS = ('LSC', 'IRa', 'SSC', 'IRb')
+# regions after origin are repeated to handle genes across origin
+REGION_INDEX = np.array([0, 1, 2, 3, 0])
+
+
+def get_regions(raw_loc) -> tuple[np.array, np.array]:
+    """
+    Args:
+        raw_loc: length, LSC length, IR length, SSC length
+    Return:
+        start and end of LSC, IRa, SSC, IRb and LSC after origin
+    """
+    length, lsc, ir, ssc = [int(i) for i in raw_loc]
+    bounds = np.array([0, lsc, lsc+ir, lsc+ir+ssc, length, length+lsc])
+    return bounds[:-1], bounds[1:]
 
 
 def get_table(csv_file) -> dict:
@@ -51,8 +48,14 @@ def get_table(csv_file) -> dict:
     id_loc = dict()
     with open(csv_file, 'r') as raw:
         for line in raw:
-            id_, _, _, lsc, ir, ssc, _ = line.split(',')
-            id_loc[id_] = (lsc, ir, ssc)
+            id_, _, length, lsc, ir, ssc, ir_b = line.strip().split(',')
+            if not all(i.strip().isdigit() for i in (lsc, ir, ssc)):
+                # header or record without regions
+                continue
+            if not length.strip().isdigit():
+                # no length, assume two IRs are equal
+                length = int(lsc) + int(ir) + int(ssc) + int(ir_b or ir)
+            id_loc[id_] = (length, lsc, ir, ssc)
     return id_loc
 
 
@@ -64,9 +67,13 @@ def get_gb() -> dict:
         id_file[id_] = gb
     return id_file
 
-import pickle
+
 def get_all_genes(gb_file) -> list:
-    gene_features = []
+    """
+    Return:
+        gene_table(list): [(gene, [(start, end), ...]), ...]
+    """
+    gene_table = []
     gb = SeqIO.read(gb_file, 'gb')
     for feature in gb.features:
         if feature.type != 'gene':
@@ -74,70 +81,245 @@ def get_all_genes(gb_file) -> list:
         if 'gene' not in feature.qualifiers:
             continue
         # feature are ordered
-        gene_features.append(feature)
-    return gene_features
+        parts = [(int(i.start), int(i.end)) for i in feature.location.parts]
+        gene_table.append((feature.qualifiers['gene'][0], parts))
+    return gene_table
+
+
+def get_file_key(gb_file) -> tuple:
+    stat = Path(gb_file).stat()
+    return str(gb_file), stat.st_size, stat.st_mtime_ns
+
+
+def read_cache(cache_file):
+    """
+    Cache is a stream of pickled (id, file key, gene_table) records.
+    Yield:
+        id_, key, gene_table
+    """
+    if not cache_file.exists():
+        return
+    with open(cache_file, 'rb') as raw:
+        while True:
+            try:
+                id_, key, gene_table = pickle.load(raw)
+            except EOFError:
+                return
+            except (OSError, ValueError, TypeError, pickle.UnpicklingError):
+                print(f'Ignore bad cache {cache_file}.')
+                return
+            yield id_, key, gene_table
+
+
+def load_genes(id_file, cache_file, jobs):
+    """
+    Read gene tables of genbank files in parallel.
+    Tables are cached in cache_file and reused if size and mtime of the
+    genbank file are unchanged. Cache and new tables are streamed, only
+    one table is kept at a time.
+    Yield:
+        id_, gene_table
+    """
+    cache_file = Path(cache_file)
+    tmp = cache_file.with_suffix('.tmp')
+    to_read = {id_: get_file_key(gb_file) for id_, gb_file in
+               id_file.items()}
+    n_cached = 0
+    with open(tmp, 'wb') as out:
+        for id_, key, gene_table in read_cache(cache_file):
+            if to_read.get(id_) != key:
+                continue
+            del to_read[id_]
+            n_cached += 1
+            pickle.dump((id_, key, gene_table), out,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            yield id_, gene_table
+        print(f'{n_cached} cached, {len(to_read)} to read.')
+        if to_read:
+            files = [id_file[i] for i in to_read]
+            with Pool(max(1, jobs)) as pool:
+                tables = pool.imap(get_all_genes, files, chunksize=16)
+                for (id_, key), gene_table in zip(to_read.items(), tables):
+                    pickle.dump((id_, key, gene_table), out,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                    yield id_, gene_table
+    tmp.replace(cache_file)
 
 
-def get_part_genes(gb_file, raw_loc) -> tuple[dict, list]:
+def get_intervals(gene_table, length) -> tuple[list, np.array]:
+    """
+    Convert gene features to intervals, one for each part of location.
+    Parts joined across origin are merged into one interval ending after
+    genome length.
+    Return:
+        genes(list): gene names
+        intervals(np.array): [[gene_index, start, end],]
+    """
+    genes = []
+    intervals = []
+    for gene, parts in gene_table:
+        index = len(genes)
+        genes.append(gene)
+        parts = list(parts)
+        tail = [i for i in parts if i[1] == length]
+        head = [i for i in parts if i[0] == 0]
+        if tail and head and tail[0] != head[0]:
+            parts.remove(tail[0])
+            parts.remove(head[0])
+            parts.append((tail[0][0], length+head[0][1]))
+        intervals.extend([index, start, end] for start, end in parts)
+    return genes, np.array(intervals, dtype=np.int64).reshape(-1, 3)
+
+
+def get_part_genes(gene_table, raw_loc) -> tuple[dict, list]:
+    """
+    Assign genes to LSC, IRa, SSC and IRb in one pass.
+    Genes may be in several regions, one record of overlap is reported for
+    each region of an interval spanning a junction:
+        (gene, overlap_len, gene_start, gene_end, part_start, part_end)
+    gene_end is smaller than gene_start if gene spans the origin.
+    """
+    length = int(raw_loc[0])
+    region_start, region_end = get_regions(raw_loc)
+    part_gene = {i: list() for i in REGIONS}
     overlap = []
-    # raw_loc: [length, length, length]
-    loc_n = [int(i) for i in raw_loc]
-    loc_range = [slice(0, loc_n[0]), slice(loc_n[0], loc_n[0]+loc_n[1]),
-                 slice(loc_n[0]+loc_n[1], loc_n[0]+loc_n[1]+loc_n[2])]
-    loc_index = 0
-    loc_index_end = len(loc_range)
-    name = ['LSC', 'IR', 'SSC', 'IR']
-    part_gene = {i: list() for i in name}
-    gene_features = get_all_genes(gb_file)
-    # ignore 2nd IR
-    len_genes = len(gene_features)
-    gene_index = 0
-    while gene_index < len_genes and loc_index < loc_index_end:
-        feature = gene_features[gene_index]
-        gene = feature.qualifiers['gene'][0]
-        if gene == 'rps12':
-            gene_index += 1
-            continue
-        part_slice = loc_range[loc_index]
-        feature_slice = slice(feature.location.start, feature.location.end)
-        cmp, overlap_len = compare_slice(feature_slice, part_slice)
-        if cmp in ('in', 'before'):
-            part_gene[name[loc_index]].append(gene)
-        elif cmp == 'after':
-            loc_index += 1
-        elif cmp == 'overlap':
-            part_gene[name[loc_index]].append(gene)
-            overlap.append((gene, overlap_len,
-                            int(feature_slice.start), int(feature_slice.stop),
-                            part_slice.start, part_slice.stop))
-            # print(gene, feature.location, part_slice, 'overlaped')
-            part_gene[name[loc_index+1]].append(gene)
-            loc_index += 1
-        else:
-            print(gene, feature.location, part_slice, cmp, 'bad')
-            break
-        gene_index += 1
+    genes, intervals = get_intervals(gene_table, length)
+    if len(intervals) == 0:
+        return part_gene, overlap
+    gene_index, start, end = intervals.T
+    # intervals x regions
+    overlap_len = np.clip(
+        np.minimum(end[:, None], region_end[None, :]) -
+        np.maximum(start[:, None], region_start[None, :]), 0, None)
+    # merge LSC before and after origin
+    region_len = overlap_len[:, :len(REGIONS)].copy()
+    region_len[:, 0] += overlap_len[:, len(REGIONS)]
+    # gene in region
+    gene_region = np.zeros((len(genes), len(REGIONS)), dtype=bool)
+    np.logical_or.at(gene_region, gene_index, region_len > 0)
+    for region, gene in zip(*np.nonzero(gene_region.T)):
+        part_gene[REGIONS[region]].append(genes[gene])
+    # intervals across junction
+    across = np.count_nonzero(region_len, axis=1) > 1
+    for i in np.flatnonzero(across):
+        # end of gene across origin
+        gene_end = int(end[i])
+        if gene_end > length:
+            gene_end -= length
+        for j in np.flatnonzero(region_len[i]):
+            region = REGION_INDEX == j
+            overlap.append((genes[gene_index[i]], int(region_len[i, j]),
+                            int(start[i]), gene_end,
+                            int(region_start[region][0]),
+                            int(region_end[region][0])))
     return part_gene, overlap
 
 
-def get_genes(id_file, id_loc) -> dict:
-    id_genes = dict()
-    id_overlap = dict()
-    for id_, gb_file in id_file.items():
+class GeneStat:
+    """
+    Streaming per-gene statistics of genomes.
+    Memory usage depends on number of genes instead of genomes.
+    Overlap length of a junction crossing is the shorter part of the gene
+    interval on two sides of the junction.
+    """
+    # upper bounds of overlap length histogram
+    bins = (10, 20, 50, 100, 200, 500, 1000, 2000)
+    columns = ('genomes', *REGIONS, 'cross', 'cross_threshold',
+               'overlap_sum', 'overlap_min', 'overlap_max',
+               *[f'overlap_lt_{i}' for i in bins], f'overlap_ge_{bins[-1]}')
+
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self.col = {j: i for i, j in enumerate(self.columns)}
+        self.hist_start = self.col[f'overlap_lt_{self.bins[0]}']
+        self.gene_stat = dict()
+
+    def get_row(self, gene) -> np.array:
+        if gene not in self.gene_stat:
+            self.gene_stat[gene] = np.zeros(len(self.columns),
+                                            dtype=np.int64)
+        return self.gene_stat[gene]
+
+    def add(self, part_gene, overlap):
+        col = self.col
+        genes = set()
+        for region, region_genes in part_gene.items():
+            for gene in set(region_genes):
+                self.get_row(gene)[col[region]] += 1
+            genes.update(region_genes)
+        for gene in genes:
+            self.gene_stat[gene][col['genomes']] += 1
+        crossing = dict()
+        for gene, overlap_len, start, end, *_ in overlap:
+            key = (gene, start, end)
+            crossing[key] = min(crossing.get(key, overlap_len), overlap_len)
+        for (gene, *_), length in crossing.items():
+            row = self.get_row(gene)
+            if row[col['cross']] == 0:
+                row[col['overlap_min']] = length
+            row[col['cross']] += 1
+            row[col['cross_threshold']] += int(length >= self.threshold)
+            row[col['overlap_sum']] += length
+            row[col['overlap_min']] = min(row[col['overlap_min']], length)
+            row[col['overlap_max']] = max(row[col['overlap_max']], length)
+            row[self.hist_start+np.searchsorted(self.bins, length,
+                                                side='right')] += 1
+
+    def to_arrays(self) -> tuple[np.array, np.array, np.array]:
+        """
+        Return:
+            genes(np.array): gene names
+            table(np.array): genes x columns
+            overlap_mean(np.array): mean overlap length, nan if no crossing
+        """
+        genes = np.array(sorted(self.gene_stat), dtype=str)
+        table = np.array([self.gene_stat[i] for i in genes],
+                         dtype=np.int64).reshape(-1, len(self.columns))
+        cross = table[:, self.col['cross']]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            overlap_mean = table[:, self.col['overlap_sum']] / cross
+        return genes, table, overlap_mean
+
+    def output(self, out) -> tuple[Path, Path]:
+        """
+        Write per-gene statistics as csv and npz.
+        """
+        genes, table, overlap_mean = self.to_arrays()
+        csv_file = out.with_suffix('.genes.csv')
+        npz_file = out.with_suffix('.genes.npz')
+        with open(csv_file, 'w') as out_csv:
+            out_csv.write(','.join(['gene', *self.columns,
+                                    'overlap_mean'])+'\n')
+            for gene, row, mean in zip(genes, table, overlap_mean):
+                out_csv.write(','.join([gene, *[str(i) for i in row],
+                                        f'{mean:.2f}'])+'\n')
+        np.savez_compressed(npz_file, gene=genes, overlap_mean=overlap_mean,
+                            **{i: table[:, j] for i, j in self.col.items()})
+        return csv_file, npz_file
+
+
+def get_genes(id_tables, id_loc, stat):
+    """
+    Assign genes of each genome and add them to stat.
+    Args:
+        id_tables: iterable of (id_, gene_table)
+    Yield:
+        id_, overlap
+    """
+    for id_, gene_table in id_tables:
         loc = id_loc[id_]
-        part_gene, overlap = get_part_genes(gb_file, loc)
-        id_genes[id_] = part_gene
-        id_overlap[id_] = overlap
-    return id_genes, id_overlap
+        part_gene, overlap = get_part_genes(gene_table, loc)
+        stat.add(part_gene, overlap)
+        yield id_, overlap
 
 
 def output_overlap(id_overlap, out_file) ->Path:
     with open(out_file, 'w') as out:
         out.write('ID,gene,overlap_len,gene_start,gene_end,'
                   'part_start,part_end\n')
-        for id_, records in id_overlap.items():
+        for id_, records in id_overlap:
             for record in records:
-                s = '{},{},{},{},{},{}\n'.format(id_, *record)
+                s = '{},{},{},{},{},{},{}\n'.format(id_, *record)
                 out.write(s)
     return out_file
 
@@ -148,14 +330,15 @@ def main():
     """
     arg = parse_args()
     arg.out = Path(arg.o)
-    global threshold
-    threshold = arg.threshold
     id_file = get_gb()
     id_loc = get_table(arg.f)
-    id_genes, id_overlap = get_genes(id_file, id_loc)
-    #print(id_genes.items())
+    id_tables = load_genes(id_file, arg.cache, arg.jobs)
+    stat = GeneStat(arg.threshold)
+    id_overlap = get_genes(id_tables, id_loc, stat)
     out_file = output_overlap(id_overlap, arg.out.with_suffix('.overlap.csv'))
     print(out_file)
+    for out_file in stat.output(arg.out):
+        print(out_file)
 
 
 if __name__ == '__main__':
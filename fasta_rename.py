@@ -1,9 +1,34 @@
 #!/usr/bin/python3
 
+import argparse
 import re
-from sys import argv
+from functools import partial
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from os import remove
+from pathlib import Path
+from shutil import copyfileobj
+from string import Formatter
 from timeit import default_timer as timer
 
+# size of chunk to read
+CHUNK_SIZE = 1 << 24
+
+
+def parse_args():
+    arg = argparse.ArgumentParser(description=main.__doc__)
+    arg.add_argument('input', nargs='+',
+                     help='input files or patterns as fasta format, old '
+                     'usage "input format" is also supported')
+    arg.add_argument('-f', dest='format',
+                     help='format of new id, e.g. "3|1|2|3!4#1"')
+    arg.add_argument('-jobs', type=int, default=cpu_count(),
+                     help='number of processes for multiple files')
+    arg.add_argument('-parts', type=int, default=1,
+                     help='split one large file into parts and rename in '
+                     'parallel')
+    return arg.parse_args()
+
 
 def get_format_string(example, SEP):
     # read line until get id
@@ -47,36 +72,229 @@ def get_format(string):
     return new_format
 
 
-def rename(old_file, new_format, SEP):
-    old = open(old_file, 'r')
-    new = open('rename-'+old_file, 'w')
-    for line in old:
-        if line[0] != '>':
-            new.write(line)
-        else:
-            line = line.strip()
-            try:
-                line = new_format.format(*(re.split(SEP, line[1:])))
-            except IndexError:
-                print('Skip invalid sequence id:')
-                print(line)
+def compile_format(new_format) -> tuple[list, int]:
+    """
+    Compile format string like "{2}|{0}" to plan of fields.
+    Return:
+        plan(list): [(literal, field index or None), ...], literal in bytes
+        max_index(int): max field index, -1 if no field
+    """
+    plan = []
+    for literal, field, spec, conversion in Formatter().parse(new_format):
+        if field is not None and (not field.isdigit() or spec or conversion):
+            raise ValueError(f'Unsupported field in {new_format}')
+        plan.append((literal.encode(),
+                     None if field is None else int(field)))
+    max_index = max([i for _, i in plan if i is not None], default=-1)
+    return plan, max_index
+
+
+def rename_header(line, plan, max_index, SEP) -> bytes:
+    """
+    Args:
+        line(bytes): header line with ">", without line break
+    Return:
+        new header with ">" and line break, None if id is invalid
+    """
+    fields = SEP.split(line.strip()[1:])
+    if len(fields) <= max_index:
+        return None
+    new = [b'>']
+    for literal, index in plan:
+        new.append(literal)
+        if index is not None:
+            new.append(fields[index])
+    new.append(b'\n')
+    return b''.join(new)
+
+
+def rename_range(old_file, start, end, new, plan, max_index,
+                 SEP) -> tuple[int, int]:
+    """
+    Rename headers of old_file[start:end] and write to new.
+    Only header lines are rebuilt, sequence lines are written as slices of
+    chunks.
+    Return:
+        renamed(int): number of renamed sequences
+        skipped(int): number of invalid ids
+    """
+    renamed = 0
+    skipped = 0
+    rest = b''
+    with open(old_file, 'rb') as old:
+        old.seek(start)
+        while start < end:
+            chunk = old.read(min(CHUNK_SIZE, end-start))
+            if not chunk:
+                break
+            start += len(chunk)
+            chunk = rest + chunk
+            # keep incomplete line for next chunk
+            line_end = chunk.rfind(b'\n') + 1
+            if start < end and line_end > 0:
+                chunk, rest = chunk[:line_end], chunk[line_end:]
+            elif start < end:
+                rest = chunk
                 continue
-            new.write('>{}\n'.format(line))
-    old.close()
-    new.close()
+            else:
+                rest = b''
+            view = memoryview(chunk)
+            pos = 0
+            while pos < len(chunk):
+                if chunk.startswith(b'>', pos):
+                    header = pos
+                else:
+                    header = chunk.find(b'\n>', pos) + 1
+                    if header == 0:
+                        new.write(view[pos:])
+                        break
+                    new.write(view[pos:header])
+                header_end = chunk.find(b'\n', header)
+                if header_end == -1:
+                    header_end = len(chunk)
+                line = chunk[header:header_end]
+                new_line = rename_header(line, plan, max_index, SEP)
+                if new_line is None:
+                    print('Skip invalid sequence id:')
+                    print(line.decode().strip())
+                    skipped += 1
+                else:
+                    new.write(new_line)
+                    renamed += 1
+                pos = header_end + 1
+    return renamed, skipped
+
+
+def get_parts(old_file, n) -> list:
+    # split file into n parts at the beginning of records
+    size = Path(old_file).stat().st_size
+    bounds = [0]
+    with open(old_file, 'rb') as raw:
+        for i in range(1, n):
+            start = max(bounds[-1], size*i//n)
+            raw.seek(start)
+            data = raw.read(CHUNK_SIZE)
+            found = -1
+            while data:
+                found = data.find(b'\n>')
+                if found != -1:
+                    break
+                start += len(data)
+                data = raw.read(CHUNK_SIZE)
+            if found == -1:
+                break
+            bounds.append(start+found+1)
+    bounds.append(size)
+    return [(i, j) for i, j in zip(bounds[:-1], bounds[1:]) if j > i]
+
+
+def rename_part(part, old_file, new_format, SEP) -> tuple[Path, int, int]:
+    start, end = part
+    plan, max_index = compile_format(new_format)
+    part_file = old_file.with_name(f'.rename-{start}-{old_file.name}')
+    with open(part_file, 'wb') as new:
+        renamed, skipped = rename_range(old_file, start, end, new, plan,
+                                        max_index, SEP)
+    return part_file, renamed, skipped
+
+
+def rename(old_file, new_format, SEP, parts=1) -> tuple[Path, int, int]:
+    """
+    Write renamed fasta to "rename-" + name in same folder.
+    Invalid ids are skipped but their sequences are kept, as before.
+    Args:
+        old_file(Path): input fasta
+        new_format(str): format string from get_format
+        SEP(str): separator pattern
+        parts(int): number of processes for one file
+    Return:
+        new_file(Path): output
+        renamed(int): number of renamed sequences
+        skipped(int): number of invalid ids
+    """
+    old_file = Path(old_file)
+    new_file = old_file.with_name('rename-'+old_file.name)
+    SEP = re.compile(SEP.encode())
+    renamed = 0
+    skipped = 0
+    # check input before create output
+    size = old_file.stat().st_size
+    plan, max_index = compile_format(new_format)
+    if parts <= 1:
+        try:
+            with open(new_file, 'wb') as new:
+                renamed, skipped = rename_range(old_file, 0, size, new,
+                                                plan, max_index, SEP)
+        except OSError:
+            remove(new_file)
+            raise
+        return new_file, renamed, skipped
+    with Pool(parts) as pool:
+        results = pool.map(partial(rename_part, old_file=old_file,
+                                   new_format=new_format, SEP=SEP),
+                           get_parts(old_file, parts))
+    with open(new_file, 'wb') as new:
+        for part_file, part_renamed, part_skipped in results:
+            with open(part_file, 'rb') as part:
+                copyfileobj(part, new, CHUNK_SIZE)
+            remove(part_file)
+            renamed += part_renamed
+            skipped += part_skipped
+    return new_file, renamed, skipped
+
+
+def rename_one(old_file, new_format, SEP, parts=1) -> tuple[str, int, int]:
+    """
+    Rename one file, for Pool.
+    Return:
+        old_file(str): input file
+        renamed(int): number of renamed sequences, None if failed
+        skipped(int): number of invalid ids
+    """
+    try:
+        new_file, renamed, skipped = rename(old_file, new_format, SEP, parts)
+    except (OSError, ValueError) as e:
+        print(f'Failed to handle {old_file}: {e}')
+        return old_file, None, 0
+    return old_file, renamed, skipped
 
 
 def main():
-    fasta_file = argv[1]
+    """
+    Rename ids of fasta files by fields of old ids.
+    """
+    arg = parse_args()
     SEP = r'[\|/:;~!\?@#$%^&\*+=]'
-
-    if len(argv) != 3:
-        format_string = get_format_string(fasta_file, SEP)
+    files = []
+    for pattern in arg.input:
+        matched = sorted(glob(pattern))
+        files.extend(matched if matched else [pattern])
+    if (arg.format is None and len(arg.input) == 2 and
+            not glob(arg.input[1]) and re.search(r'\d', arg.input[1])):
+        # old usage: fasta_rename.py input format, format has field index
+        arg.format = files.pop()
+    if arg.format is None:
+        # ask only once
+        format_string = get_format_string(files[0], SEP)
+        if format_string is None:
+            return
     else:
-        format_string = argv[2].strip('"')
+        format_string = arg.format.strip('"')
     new_format = get_format(format_string)
     start = timer()
-    rename(fasta_file, new_format, SEP)
+    if len(files) == 1:
+        results = [rename_one(files[0], new_format, SEP, arg.parts)]
+    else:
+        with Pool(max(1, min(arg.jobs, len(files)))) as pool:
+            results = pool.map(partial(rename_one, new_format=new_format,
+                                       SEP=SEP), files, chunksize=1)
+        failed = [i[0] for i in results if i[1] is None]
+        print('Renamed {} sequences in {} files, skipped {}, {} files '
+              'failed.'.format(sum(i[1] for i in results if i[1]),
+                               len(results), sum(i[2] for i in results),
+                               len(failed)))
+        for i in failed:
+            print('Failed:', i)
     end = timer()
     print('Finished with {0:.3f} s.'.format(end-start))
 
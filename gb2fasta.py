@@ -1,14 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import json
+import logging
 import re
+from collections import OrderedDict
+from copy import copy
+from itertools import zip_longest
+from io import BufferedReader, RawIOBase, TextIOWrapper
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Pool
+from shutil import copyfileobj, rmtree
 from timeit import default_timer as timer
-from subprocess import run
-from os import mkdir, remove, cpu_count
-from os.path import join as join_path
+from os import listdir, makedirs, mkdir, remove, replace
+from os.path import basename, exists, getsize, join as join_path
 from Bio.SeqFeature import SeqFeature, FeatureLocation
 from Bio import SeqIO
 from gene_rename import rename
+from align_scheduler import AlignCache, AlignJob, run_jobs
 
 
 def parse_args():
@@ -21,6 +30,27 @@ def parse_args():
                      help='try to rename gene')
     arg.add_argument('-align', action='store_true',
                      help='use mafft to alignment')
+    arg.add_argument('-incremental', action='store_true',
+                     help='only add records not processed before to '
+                     'existing output, and align with mafft --add')
+    arg.add_argument('-aln_cache',
+                     help='folder to cache alignments between runs')
+    arg.add_argument('-max_handles', type=int, default=256,
+                     help='maximum number of opened output files')
+    arg.add_argument('-buffer_size', type=int, default=65536,
+                     help='buffer size (bytes) of each output file')
+    arg.add_argument('-jobs', type=int, default=1,
+                     help='number of processes to divide genbank file')
+    arg.add_argument('-name_cache',
+                     help='file to load and save gene name cache')
+    arg.add_argument('-name_cache_size', type=int, default=65536,
+                     help='maximum number of cached gene names')
+    arg.add_argument('-engine', choices=('seqio', 'fast'), default='seqio',
+                     help='genbank parser, fast engine only reads fields '
+                     'used for divide')
+    arg.add_argument('-check_engine', action='store_true',
+                     help='compare fast engine with Bio.SeqIO on given '
+                     'file and exit')
     return arg.parse_args()
 
 
@@ -28,6 +58,93 @@ def safe(old):
     return re.sub(r'\W', '_', old)
 
 
+class NameCache:
+    """
+    Bounded LRU cache of gene name -> renamed and safe name.
+    Could be saved as tab-separated file to reuse between runs.
+    """
+    def __init__(self, rename_gene=True, max_size=65536):
+        self.rename_gene = rename_gene
+        self.max_size = max_size
+        self.names = OrderedDict()
+        self.hit = 0
+        self.miss = 0
+        # new names since last reset, only recorded in workers
+        self.added = None
+
+    def get(self, gene):
+        name = self.names.get(gene)
+        if name is not None:
+            self.hit += 1
+            self.names.move_to_end(gene)
+            return name
+        self.miss += 1
+        if self.rename_gene:
+            name = safe(rename(gene)[0])
+        else:
+            name = safe(gene)
+        self.add(gene, name)
+        if self.added is not None:
+            self.added.append((gene, name))
+        return name
+
+    def copy(self):
+        # snapshot without counters
+        new = NameCache(self.rename_gene, self.max_size)
+        new.names = OrderedDict(self.names)
+        return new
+
+    def get_delta(self):
+        # counters and new names since last reset
+        delta = NameCache(self.rename_gene, self.max_size)
+        delta.hit = self.hit
+        delta.miss = self.miss
+        for gene, name in self.added or []:
+            delta.add(gene, name)
+        return delta
+
+    def reset(self):
+        self.hit = 0
+        self.miss = 0
+        self.added = []
+
+    def add(self, gene, name):
+        self.names[gene] = name
+        self.names.move_to_end(gene)
+        if len(self.names) > self.max_size:
+            self.names.popitem(last=False)
+
+    def merge(self, other):
+        # merge cache and counters from worker
+        self.hit += other.hit
+        self.miss += other.miss
+        for gene, name in other.names.items():
+            self.add(gene, name)
+
+    def load(self, filename):
+        # first line records whether gene was renamed
+        if not exists(filename):
+            return 0
+        with open(filename, 'r', encoding='utf-8') as raw:
+            if raw.readline().strip() != '#rename\t{}'.format(
+                    self.rename_gene):
+                print('Skip name cache {} of different rename '
+                      'option.'.format(filename))
+                return 0
+            for line in raw:
+                gene, _, name = line.rstrip('\n').partition('\t')
+                if name:
+                    self.add(gene, name)
+        return len(self.names)
+
+    def save(self, filename):
+        with open(filename, 'w', encoding='utf-8') as out:
+            out.write('#rename\t{}\n'.format(self.rename_gene))
+            for gene, name in self.names.items():
+                out.write('{}\t{}\n'.format(gene, name))
+        return filename
+
+
 def get_taxon(lineage, family_exception):
     superkingdom = ''
     kingdom = None
@@ -54,16 +171,371 @@ def get_taxon(lineage, family_exception):
     return Type, order, family
 
 
-def write_seq(name, sequence_id, feature, whole_seq, path, arg):
+# for fast engine
+UPPER = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz',
+                        b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+COMPLEMENT = str.maketrans('ACGTRYKMBVDHUacgtrykmbvdhu',
+                           'TGCAYRMKVBHDAtgcayrmkvbhda')
+FEATURE_INDENT = 21
+HEADER_INDENT = 12
+
+
+class GbLocation:
+    """
+    Location of GbFeature, parts are [(start, end, strand),] with 0-based
+    start, same order as Bio.SeqFeature.CompoundLocation.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+        self.start = min(i[0] for i in parts)
+        self.end = max(i[1] for i in parts)
+        strands = set(i[2] for i in parts)
+        self.strand = strands.pop() if len(strands) == 1 else None
+
+    def __len__(self):
+        return sum(end-start for start, end, _ in self.parts)
+
+
+class GbFeature:
+    """
+    Lightweight SeqFeature, location and qualifiers are parsed on demand.
+    """
+    def __init__(self, type_, lines=None, location=None, id_=''):
+        self.type = type_
+        self.id = id_
+        self._lines = lines
+        self._location = location
+        self._qualifiers = dict()
+
+    def _parse(self):
+        self._location, self._qualifiers = parse_feature_lines(self._lines)
+        self._lines = None
+
+    @property
+    def location(self):
+        if self._lines is not None:
+            self._parse()
+        return self._location
+
+    @property
+    def qualifiers(self):
+        if self._lines is not None:
+            self._parse()
+        return self._qualifiers
+
+    def __len__(self):
+        return len(self.location)
+
+    def extract(self, whole_seq):
+        """
+        Same as SeqFeature.extract, but whole_seq is bytes.
+        Return: str
+        """
+        fragments = list()
+        for start, end, strand in self.location.parts:
+            fragment = whole_seq[start:end].decode()
+            if strand == -1:
+                fragment = fragment.translate(COMPLEMENT)[::-1]
+            fragments.append(fragment)
+        return ''.join(fragments)
+
+
+class GbRecord:
+    """
+    Lightweight SeqRecord, only contains fields used by divide.
+    Sequence is one contiguous bytes.
+    """
+    def __init__(self, id_, annotations, features, seq):
+        self.id = id_
+        self.description = ''
+        self.annotations = annotations
+        self.features = features
+        self.seq = seq
+
+    def format(self, format_):
+        # same output as SeqRecord.format('fasta')
+        if format_ != 'fasta':
+            raise ValueError('Unsupport format {}.'.format(format_))
+        if self.description and self.description.split(None,
+                                                       1)[0] == self.id:
+            title = self.description
+        elif self.description:
+            title = '{} {}'.format(self.id, self.description)
+        else:
+            title = self.id
+        seq = self.seq.decode()
+        lines = ['>'+title]
+        lines.extend(seq[i:i+60] for i in range(0, len(seq), 60))
+        return '\n'.join(lines) + '\n'
+
+
+def split_location(text):
+    """
+    Split location string by comma outside of brackets.
+    """
+    items = list()
+    depth = 0
+    begin = 0
+    for index, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(text[begin:index])
+            begin = index + 1
+    items.append(text[begin:])
+    return items
+
+
+def parse_location(text):
+    """
+    Parse genbank location string like Bio.GenBank.
+    Support complement, join, order, fuzzy and between positions.
+    Return: [(start, end, strand),]
+    """
+    if text.startswith('complement(') and text.endswith(')'):
+        parts = parse_location(text[11:-1])
+        return [(start, end, -strand) for start, end, strand in
+                reversed(parts)]
+    if text.startswith(('join(', 'order(')) and text.endswith(')'):
+        parts = list()
+        for item in split_location(text[text.index('(')+1:-1]):
+            parts.extend(parse_location(item))
+        return parts
+    if ':' in text:
+        raise ValueError('Remote location {} is not supported.'.format(text))
+    text = text.replace('<', '').replace('>', '')
+    if '..' in text:
+        start, end = text.split('..')
+        return [(int(start)-1, int(end), 1)]
+    elif '^' in text:
+        start, _ = text.split('^')
+        return [(int(start), int(start), 1)]
+    else:
+        return [(int(text)-1, int(text), 1)]
+
+
+def parse_feature_lines(lines):
+    """
+    Parse location and qualifiers of feature like Bio.GenBank.Scanner.
+    Args:
+        lines: feature lines without indent, first one is location
+    Return: GbLocation, qualifiers(dict)
+    """
+    lines = iter([i for i in lines if i])
+    location = next(lines)
+    while location[-1:] == ',' or location.count('(') > location.count(
+            ')'):
+        location += next(lines)
+    qualifiers = dict()
+    key = None
+    for line in lines:
+        if line[0] != '/':
+            # unquoted continuation
+            if key is not None:
+                qualifiers[key][-1] += ' ' + line
+            continue
+        key, equal, value = line[1:].partition('=')
+        if not equal:
+            # such as /pseudo
+            qualifiers.setdefault(key, ['', ])
+            key = None
+            continue
+        value = value.lstrip()
+        if value[:1] == '"' and value != '"':
+            value_list = [value]
+            while value_list[-1][-1] != '"':
+                value_list.append(next(lines))
+            value = ' '.join(value_list)
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        value = value.replace('""', '"')
+        qualifiers.setdefault(key, list()).append(value)
+    return GbLocation(parse_location(location)), qualifiers
+
+
+def parse_gb_header(header):
+    """
+    Get accessions, organism and taxonomy from genbank header.
+    Return: annotations(dict)
+    """
+    accessions = list()
+    organism = ''
+    lineage = ''
+    lines = iter([i.rstrip() for i in header.split('\n') if i.strip()])
+    line = next(lines, '')
+    while line:
+        line_type = line[:HEADER_INDENT].strip()
+        if line_type == 'ACCESSION' and not accessions:
+            accessions = line[HEADER_INDENT:].replace(';', ' ').split()
+        elif line_type == 'ORGANISM':
+            organism = line[HEADER_INDENT:].strip()
+            for line in lines:
+                if line[:HEADER_INDENT] != ' '*HEADER_INDENT:
+                    break
+                if lineage or ';' in line:
+                    lineage += ' ' + line[HEADER_INDENT:]
+                elif line[HEADER_INDENT:].strip() != '.':
+                    organism += ' ' + line[HEADER_INDENT:].strip()
+            else:
+                line = ''
+            continue
+        line = next(lines, '')
+    lineage = lineage.strip()
+    if lineage in ('', '.'):
+        taxonomy = list()
+    else:
+        taxonomy = [i.strip() for i in
+                    lineage.rstrip('.').replace('\n', ';').split(';')
+                    if i.strip()]
+    return {'accessions': accessions, 'organism': organism,
+            'taxonomy': taxonomy}
+
+
+def parse_gb_record(data):
+    """
+    Parse one genbank record (bytes, without "//" line).
+    Return: GbRecord
+    """
+    feature_start = data.find(b'\nFEATURES ')
+    origin_start = data.find(b'\nORIGIN')
+    if origin_start == -1:
+        origin_start = len(data)
+    if feature_start == -1:
+        feature_start = origin_start
+    annotations = parse_gb_header(data[:feature_start].decode())
+    features = list()
+    # skip "FEATURES" line
+    table_start = data.find(b'\n', feature_start+1)
+    if -1 < table_start < origin_start:
+        lines = None
+        for line in data[table_start+1:origin_start].decode().split('\n'):
+            line = line.rstrip()
+            if not line:
+                continue
+            if line[2:FEATURE_INDENT].strip():
+                lines = [line[FEATURE_INDENT:]]
+                features.append(GbFeature(line[2:FEATURE_INDENT].strip(),
+                                          lines))
+            elif lines is not None:
+                lines.append(line[FEATURE_INDENT:].strip())
+    seq_start = data.find(b'\n', origin_start+1)
+    if seq_start == -1:
+        seq = b''
+    else:
+        seq = data[seq_start+1:].translate(UPPER, b' \t\r\n0123456789')
+    accession = annotations['accessions'][0] if annotations[
+        'accessions'] else ''
+    return GbRecord(accession, annotations, features, seq)
+
+
+def iter_gb_chunks(handle, chunk_size=1 << 24):
+    """
+    Split genbank stream into records without parsing.
+    Yield: bytes of one record, including "//" line
+    """
+    rest = b''
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        data = rest + chunk
+        begin = 0
+        while True:
+            end = data.find(b'\n//', begin)
+            if end == -1:
+                break
+            line_end = data.find(b'\n', end+1)
+            if line_end == -1:
+                break
+            yield data[begin:line_end+1]
+            begin = line_end + 1
+        rest = data[begin:]
+    if rest.strip():
+        yield rest
+
+
+def scan_gb(handle, chunk_size=1 << 24):
+    """
+    Fast engine, stream genbank records from binary handle or filename.
+    Yield: GbRecord
+    """
+    if isinstance(handle, str):
+        with open(handle, 'rb') as raw:
+            yield from scan_gb(raw, chunk_size)
+        return
+    for data in iter_gb_chunks(handle, chunk_size):
+        # remove "//" line
+        end = data.rfind(b'\n//')
+        if end != -1:
+            data = data[:end+1]
+        yield parse_gb_record(data)
+
+
+def parse_gb(handle, arg):
+    """
+    Return genbank record iterator of selected engine.
+    Fast engine needs filename or binary handle.
+    """
+    if arg.engine == 'fast':
+        return scan_gb(handle)
+    return SeqIO.parse(handle, 'gb')
+
+
+class HandlePool:
+    """
+    Bounded LRU pool of buffered output handles, keyed by filename.
+    Files are opened in append mode, so a handle closed by eviction could be
+    reopened later without losing data.
+    """
+    def __init__(self, max_handles=256, buffer_size=65536):
+        self.max_handles = max(1, max_handles)
+        self.buffer_size = buffer_size
+        self.handles = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def get(self, filename):
+        handle = self.handles.get(filename)
+        if handle is not None:
+            self.handles.move_to_end(filename)
+            return handle
+        if len(self.handles) >= self.max_handles:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        handle = open(filename, 'a', buffering=self.buffer_size)
+        self.handles[filename] = handle
+        return handle
+
+    def close(self):
+        # close all even if some of them failed
+        error = None
+        while self.handles:
+            _, handle = self.handles.popitem(last=False)
+            try:
+                handle.close()
+            except OSError as e:
+                error = e
+        if error is not None:
+            raise error
+
+
+def write_seq(name, sequence_id, feature, whole_seq, path, pool):
     """
     Write fasta file.
     """
     filename = join_path(path, name+'.fasta')
     sequence = feature.extract(whole_seq)
 
-    with open(filename, 'a') as handle:
-        handle.write(sequence_id+'\n')
-        handle.write(str(sequence)+'\n')
+    handle = pool.get(filename)
+    handle.write(sequence_id+'\n')
+    handle.write(str(sequence)+'\n')
     return filename
 
 
@@ -79,9 +551,7 @@ def get_feature_name(feature, arg):
     if feature.type == 'gene':
         if 'gene' in feature.qualifiers:
             gene = feature.qualifiers['gene'][0].replace(' ', '_')
-            if not arg.no_rename:
-                gene = rename(gene)[0]
-            name = safe(gene)
+            name = arg.names.get(gene)
         elif 'product' in feature.qualifiers:
             product = feature.qualifiers['product'][0].replace(' ', '_')
             name = safe(product)
@@ -152,47 +622,48 @@ def get_spacer(genes, arg):
         else:
             strand = 1
         name = '_'.join([before[0], present[0]])
-        spacer = SeqFeature(FeatureLocation(start, end), id=name,
-                            type='spacer', strand=strand)
+        if isinstance(present[1], GbFeature):
+            spacer = GbFeature('spacer', id_=name, location=GbLocation(
+                [(int(start), int(end), strand)]))
+        else:
+            spacer = SeqFeature(FeatureLocation(start, end), id=name,
+                                type='spacer', strand=strand)
         spacers.append(spacer)
     return spacers
 
 
-def divide(arg):
+def divide_records(records, groupby_gene, groupby_name, handle_raw, pool,
+                   arg):
     """
-    Given genbank file, return divided fasta files.
+    Divide given genbank records into fasta files of groupby_gene and
+    groupby_name folders.
     From Zhang guojin
     order end with ales
     family end with aceae except 8
     http://duocet.ibiodiversity.net/index.php?title=%E4%BA%92%E7%94%A8%E5%90%8D
     %E7%A7%B0&mobileaction=toggle_view_mobile
+    Return: wrote_by_gene(set), wrote_by_name(set)
     """
     # kingdom|order|family|organims(genus|species)
     family_exception_raw = (
         'Umbelliferae,Palmae,Compositae,Cruciferae,Guttiferae,Leguminosae,'
         'Leguminosae,Papilionaceae,Labiatae,Gramineae')
     family_exception = family_exception_raw[0].split(',')
-    start = timer()
-    groupby_gene = join_path(arg.out, '{}-groupby_gene'.format(arg.out))
-    mkdir(groupby_gene)
-    groupby_name = join_path(arg.out, '{}-groupby_name'.format(arg.out))
-    mkdir(groupby_name)
-    handle_raw = open(arg.gbfile+'.fasta', 'w')
     wrote_by_gene = set()
     wrote_by_name = set()
-
-    for record in SeqIO.parse(arg.gbfile, 'gb'):
+    for record in records:
         # only accept gene, product, and spacer in misc_features.note
         lineage = record.annotations['taxonomy']
         # kingdom or superkingdom
         kingdom, order, family = get_taxon(lineage, family_exception)
         organism = record.annotations['organism'].replace(' ', '_')
         genus, *species = organism.split('_')
-        taxon = '|'.join([kingdom, order, family, genus, '_'.join(species)])
+        taxon = '|'.join([kingdom, order, family, genus,
+                          '_'.join(species)])
         accession = record.annotations['accessions'][0]
         try:
-            specimen = record.features[0].qualifiers['specimen_voucher'
-                                                     ][0].replace(' ', '_')
+            specimen = record.features[0].qualifiers[
+                'specimen_voucher'][0].replace(' ', '_')
         except (IndexError, KeyError):
             specimen = ''
         whole_seq = record.seq
@@ -215,9 +686,10 @@ def divide(arg):
             if feature_type == 'gene':
                 genes.append([name, feature])
             feature_name.append(name)
-            sequence_id = '>' + '|'.join([name, taxon, accession, specimen])
+            sequence_id = '>' + '|'.join([name, taxon, accession,
+                                          specimen])
             wrote = write_seq(name, sequence_id, feature, whole_seq,
-                              groupby_gene, arg)
+                              groupby_gene, pool)
             wrote_by_gene.add(wrote)
 
         # extract spacer
@@ -225,14 +697,15 @@ def divide(arg):
         for spacer in spacers:
             sequence_id = '>' + '|'.join([spacer.id, taxon,
                                           accession, specimen])
-            wrote = write_seq(spacer.id, sequence_id, spacer, whole_seq,
-                              groupby_gene, arg)
+            wrote = write_seq(spacer.id, sequence_id, spacer,
+                              whole_seq, groupby_gene, pool)
             wrote_by_gene.add(wrote)
         # write to group_by name, i.e., one gb record one fasta
         if 'ITS' in feature_name:
             name_str = 'ITS'
         elif len(feature_name) >= 4:
-            name_str = '{}-...-{}'.format(feature_name[0], feature_name[-1])
+            name_str = '{}-...-{}'.format(feature_name[0],
+                                          feature_name[-1])
         elif len(feature_name) == 0:
             name_str = 'Unknown'
         else:
@@ -240,42 +713,388 @@ def divide(arg):
         record.id = '|'.join([name_str, taxon, accession, specimen])
         record.description = ''
         filename = join_path(groupby_name, name_str+'.fasta')
-        with open(filename, 'a') as out:
-            SeqIO.write(record, out, 'fasta')
-            wrote_by_name.add(filename)
+        fasta = record.format('fasta')
+        pool.get(filename).write(fasta)
+        wrote_by_name.add(filename)
         # write raw fasta
-        SeqIO.write(record, handle_raw, 'fasta')
+        handle_raw.write(fasta)
+
+    return wrote_by_gene, wrote_by_name
+
+
+def get_shards(gbfile, n):
+    """
+    Split genbank file into at most n byte ranges, at the end of "//" lines.
+    Return: [(start, end),]
+    """
+    size = getsize(gbfile)
+    if size == 0 or n <= 1:
+        return [(0, size)]
+    shards = list()
+    start = 0
+    with open(gbfile, 'rb') as raw, mmap(raw.fileno(), 0,
+                                         access=ACCESS_READ) as data:
+        for i in range(1, n):
+            target = max(start, size*i//n)
+            # record end, "//" at the beginning of line
+            end = data.find(b'\n//', max(target-1, 0))
+            if end == -1:
+                break
+            end = data.find(b'\n', end+1)
+            if end == -1:
+                break
+            end += 1
+            if end > start:
+                shards.append((start, end))
+                start = end
+    if start < size:
+        shards.append((start, size))
+    return shards
+
+
+class RangeReader(RawIOBase):
+    """
+    Read only [start, end) of binary file, so shard is streamed instead of
+    being loaded into memory.
+    """
+    def __init__(self, raw, start, end):
+        self.raw = raw
+        self.raw.seek(start)
+        self.left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.left)
+        if size <= 0:
+            return 0
+        n = self.raw.readinto(memoryview(buffer)[:size])
+        self.left -= n
+        return n
+
+
+# name cache of worker process, kept between shards
+worker_names = None
+
+
+def init_worker(names):
+    global worker_names
+    worker_names = names
+
+
+def divide_shard(task):
+    """
+    Worker of divide, write one shard of genbank file into its own folder.
+    Return: shard_dir, counters and new names of the shard
+    """
+    gbfile, start, end, shard_dir, arg = task
+    worker_names.reset()
+    arg.names = worker_names
+    mkdir(shard_dir)
+    mkdir(join_path(shard_dir, 'gene'))
+    mkdir(join_path(shard_dir, 'name'))
+    pool = HandlePool(arg.max_handles, arg.buffer_size)
+    with open(gbfile, 'rb', buffering=0) as raw, BufferedReader(
+            RangeReader(raw, start, end)) as shard:
+        if arg.engine == 'fast':
+            records = parse_gb(shard, arg)
+        else:
+            records = parse_gb(TextIOWrapper(shard, encoding='utf-8'),
+                               arg)
+        with pool, open(join_path(shard_dir, 'raw.fasta'),
+                        'w') as handle_raw:
+            divide_records(records, join_path(shard_dir, 'gene'),
+                           join_path(shard_dir, 'name'), handle_raw, pool,
+                           arg)
+    return shard_dir, worker_names.get_delta()
+
+
+def merge_shard(shard_dir, groupby_gene, groupby_name, handle_raw):
+    """
+    Append partial fasta files of one shard to final files, then remove
+    the shard.
+    Return: wrote_by_gene(set), wrote_by_name(set)
+    """
+    wrote_by_gene = set()
+    wrote_by_name = set()
+    for sub, dest, wrote in (('gene', groupby_gene, wrote_by_gene),
+                             ('name', groupby_name, wrote_by_name)):
+        folder = join_path(shard_dir, sub)
+        for name in sorted(listdir(folder)):
+            filename = join_path(dest, name)
+            with open(join_path(folder, name), 'rb') as part, open(
+                    filename, 'ab') as out:
+                copyfileobj(part, out)
+            wrote.add(filename)
+    with open(join_path(shard_dir, 'raw.fasta'), 'rb') as part:
+        copyfileobj(part, handle_raw)
+    rmtree(shard_dir)
+    return wrote_by_gene, wrote_by_name
+
+
+def divide(arg, gbfile=None, mode='w'):
+    """
+    Given genbank file, return divided fasta files.
+    With more than one job, the file is split into shards at record
+    boundaries and shards are merged in order, so the output is the same as
+    sequential mode.
+    Args:
+        gbfile: genbank file to divide, arg.gbfile by default
+        mode: 'w' or 'a', mode to open raw fasta
+    """
+    if gbfile is None:
+        gbfile = arg.gbfile
+    start = timer()
+    arg.names = NameCache(not arg.no_rename, arg.name_cache_size)
+    if arg.name_cache is not None:
+        arg.names.load(arg.name_cache)
+    groupby_gene = join_path(arg.out, '{}-groupby_gene'.format(arg.out))
+    makedirs(groupby_gene, exist_ok=True)
+    groupby_name = join_path(arg.out, '{}-groupby_name'.format(arg.out))
+    makedirs(groupby_name, exist_ok=True)
+
+    if arg.jobs <= 1:
+        pool = HandlePool(arg.max_handles, arg.buffer_size)
+        with pool, open(arg.gbfile+'.fasta', mode) as handle_raw:
+            records = parse_gb(gbfile, arg)
+            wrote_by_gene, wrote_by_name = divide_records(
+                records, groupby_gene, groupby_name, handle_raw, pool, arg)
+    else:
+        wrote_by_gene = set()
+        wrote_by_name = set()
+        # more shards than workers to balance the load
+        shards = get_shards(gbfile, arg.jobs*4)
+        # name cache is sent to workers once, not with every task
+        task_arg = copy(arg)
+        task_arg.names = None
+        tasks = [(gbfile, shard_start, shard_end,
+                  join_path(arg.out, '.shard-{}'.format(index)), task_arg)
+                 for index, (shard_start, shard_end) in enumerate(shards)]
+        print('Divide {} shards with {} jobs.'.format(len(shards), arg.jobs))
+        snapshot = arg.names.copy()
+        with Pool(arg.jobs, init_worker, (snapshot, )) as workers, open(
+                arg.gbfile+'.fasta', mode+'b') as handle_raw:
+            # imap keeps the order of shards
+            for shard_dir, names in workers.imap(divide_shard, tasks):
+                arg.names.merge(names)
+                by_gene, by_name = merge_shard(shard_dir, groupby_gene,
+                                               groupby_name, handle_raw)
+                wrote_by_gene.update(by_gene)
+                wrote_by_name.update(by_name)
 
     end = timer()
     print('Divide done with {:.3f}s.'.format(end-start))
+    print('Gene name cache: {} hits, {} misses.'.format(arg.names.hit,
+                                                        arg.names.miss))
+    if arg.name_cache is not None:
+        arg.names.save(arg.name_cache)
     return wrote_by_gene, wrote_by_name
 
 
-def mafft(files):
-    failed = list()
-    # get available CPU cores
-    cores = cpu_count()
+def get_accession(data) -> str:
+    # first accession of genbank record (bytes)
+    match = re.search(rb'^ACCESSION +(\S+)', data, re.M)
+    if match is None:
+        return ''
+    return match.group(1).decode()
+
+
+def load_manifest(filename) -> dict:
+    """
+    Manifest of incremental mode.
+    records: accessions already divided
+    genes: gene fasta file name -> accessions in the file
+    """
+    if not exists(filename):
+        return {'records': list(), 'genes': dict()}
+    with open(filename, 'r', encoding='utf-8') as raw:
+        return json.load(raw)
+
+
+def save_manifest(manifest, filename):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as out:
+        json.dump(manifest, out, indent=0)
+    replace(tmp, filename)
+    return filename
+
+
+def write_new_records(gbfile, processed, new_gb) -> list:
+    """
+    Copy records not in processed to new_gb, without parsing.
+    Return: accessions of new records
+    """
+    new = list()
+    with open(gbfile, 'rb') as raw, open(new_gb, 'wb') as out:
+        for data in iter_gb_chunks(raw):
+            accession = get_accession(data)
+            if accession in processed:
+                continue
+            out.write(data)
+            new.append(accession)
+    return new
+
+
+def divide_incremental(arg):
+    """
+    Only divide records not found in manifest, append their features to
+    existing fasta files, and collect added sequences of every gene file.
+    Sequences of failed mafft --add are kept in .add files and retried.
+    Return: wrote_by_gene(set), wrote_by_name(set),
+        added(dict): fasta file -> fasta of added sequences, if arg.align
+    """
+    manifest_file = join_path(arg.out, 'manifest.json')
+    manifest = load_manifest(manifest_file)
+    new_gb = join_path(arg.out, 'new_records.gb')
+    new = write_new_records(arg.gbfile, set(manifest['records']), new_gb)
+    print('Found {} new records, {} records were processed before.'.format(
+        len(new), len(manifest['records'])))
+    groupby_gene = join_path(arg.out, '{}-groupby_gene'.format(arg.out))
+    old_size = dict()
+    if exists(groupby_gene):
+        for name in listdir(groupby_gene):
+            filename = join_path(groupby_gene, name)
+            old_size[filename] = getsize(filename)
+    wrote_by_gene, wrote_by_name = divide(arg, new_gb, 'a')
+    remove(new_gb)
+    # sequences added to each gene file, for mafft --add
+    added = dict()
+    for filename in wrote_by_gene:
+        with open(filename, 'rb') as raw:
+            raw.seek(old_size.get(filename, 0))
+            new_part = raw.read()
+        accessions = manifest['genes'].setdefault(basename(filename), list())
+        for line in new_part.splitlines():
+            if line.startswith(b'>'):
+                # name|kingdom|order|family|genus|species|accession|specimen
+                accessions.append(line.decode().split('|')[6])
+        if arg.align:
+            # append to sequences left by failed mafft of last run
+            delta = filename + '.add'
+            with open(delta, 'ab') as out:
+                out.write(new_part)
+            added[filename] = delta
+    if arg.align and exists(groupby_gene):
+        # retry genes without new sequences but failed last time
+        for name in listdir(groupby_gene):
+            if name.endswith('.fasta.add'):
+                delta = join_path(groupby_gene, name)
+                added.setdefault(delta[:-len('.add')], delta)
+    manifest['records'].extend(new)
+    save_manifest(manifest, manifest_file)
+    return wrote_by_gene, wrote_by_name, added
+
+
+def mafft(files, cache_dir=None):
+    print('Start mafft ...')
+    jobs = [AlignJob(fasta, fasta+'.aln',
+                     options=('--reorder', '--quiet', '--adjustdirection'))
+            for fasta in files]
+    cache = None if cache_dir is None else AlignCache(cache_dir)
+    # use all available CPU cores except one
+    run_jobs(jobs, cache=cache)
+    failed = [str(job.out) for job in jobs if job.returncode != 0]
+    print('Done with mafft.')
+    return failed
+
+
+def mafft_add(added, cache_dir=None):
+    """
+    Add new sequences to existing alignments by mafft --add, genes without
+    alignment are aligned from scratch.
+    Args:
+        added(dict): fasta file -> fasta of added sequences
+    """
+    options = ('--reorder', '--quiet', '--adjustdirection')
     print('Start mafft ...')
-    for fasta in files:
-        print('Aligning {}'.format(fasta))
-        out = fasta + '.aln'
-        _ = ('mafft --thread {} --reorder --quiet --adjustdirection '
-             ' {} > {}'.format(cores-1, fasta, out))
-        m = run(_, shell=True)
-        if m.returncode != 0:
-            failed.append(out)
+    jobs = list()
+    for fasta, delta in added.items():
+        aln = fasta + '.aln'
+        if exists(aln):
+            jobs.append(AlignJob(delta, aln+'.new', options, ref=aln))
+        else:
+            jobs.append(AlignJob(fasta, aln, options))
+    cache = None if cache_dir is None else AlignCache(cache_dir)
+    run_jobs(jobs, cache=cache)
+    failed = list()
+    for delta, job in zip(added.values(), jobs):
+        if job.returncode != 0:
+            # keep .add file, retried by next incremental run
+            failed.append(str(job.out))
+            continue
+        if job.ref is not None:
+            replace(job.out, job.ref)
+        remove(delta)
     print('Done with mafft.')
     return failed
 
 
+def check_engine(gbfile):
+    """
+    Compare fast engine with Bio.SeqIO, on fields and feature sequences used
+    by divide.
+    Return: number of different records
+    """
+    keys = ('gene', 'product', 'locus_tag', 'note', 'specimen_voucher')
+    n = 0
+    n_bad = 0
+    for old, new in zip_longest(SeqIO.parse(gbfile, 'gb'), scan_gb(gbfile)):
+        n += 1
+        if old is None or new is None:
+            print('Different number of records.')
+            n_bad += 1
+            break
+        accession = old.annotations['accessions'][0]
+        diff = list()
+        for key in ('accessions', 'organism', 'taxonomy'):
+            if old.annotations.get(key) != new.annotations[key]:
+                diff.append(key)
+        if str(old.seq) != new.seq.decode():
+            diff.append('sequence')
+        if len(old.features) != len(new.features):
+            diff.append('number of features')
+        for a, b in zip(old.features, new.features):
+            name = '{} {}'.format(a.type, a.location)
+            if a.type != b.type:
+                diff.append(name+' type')
+                continue
+            if [a.qualifiers.get(i) for i in keys] != [
+                    b.qualifiers.get(i) for i in keys]:
+                diff.append(name+' qualifiers')
+            if (int(a.location.start), int(a.location.end),
+                    a.location.strand, len(a)) != (
+                    b.location.start, b.location.end, b.location.strand,
+                    len(b)):
+                diff.append(name+' location')
+            elif str(a.extract(old.seq)) != b.extract(new.seq):
+                diff.append(name+' extract')
+        if diff:
+            n_bad += 1
+            print('{}: {}'.format(accession, ', '.join(diff)))
+    print('Checked {} records, {} different.'.format(n, n_bad))
+    return n_bad
+
+
 def main():
     arg = parse_args()
+    if arg.check_engine:
+        check_engine(arg.gbfile)
+        return
     if arg.out is None:
         arg.out = arg.gbfile.replace('.gb', '')
-    mkdir(arg.out)
-    wrote_by_gene, wrote_by_name = divide(arg)
+    if arg.incremental:
+        makedirs(arg.out, exist_ok=True)
+        wrote_by_gene, wrote_by_name, added = divide_incremental(arg)
+    else:
+        mkdir(arg.out)
+        wrote_by_gene, wrote_by_name = divide(arg)
     if arg.align:
-        failed = mafft(wrote_by_gene)
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        if arg.incremental:
+            failed = mafft_add(added, arg.aln_cache)
+        else:
+            failed = mafft(wrote_by_gene, arg.aln_cache)
         for i in failed:
             print('Remove empty (failed alignment) file {}.'.format(i))
             remove(i)
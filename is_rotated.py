@@ -1,20 +1,132 @@
 #!/usr/bin/python3
 
-from Bio import SeqIO
-from sys import argv
+import argparse
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 
-rotated_need_reannotate = open('rotated_need_reannotate.csv', 'a')
-no_rotate = open('no_rotate.csv', 'a')
-same = open('same.csv', 'a')
-raw_gb = Path(argv[1]).absolute()
-rotated_fasta = Path(argv[1]+'-out/'+argv[1]+'.fasta')
-if not rotated_fasta.exists():
-    no_rotate.write(argv[1]+'\n')
-else:
+from Bio import SeqIO
+
+COMPLEMENT = bytes.maketrans(b'ATGCRYMKBDHVN', b'TACGYRKMVHDBN')
+# status: output file
+OLD_OUTPUT = {'no_rotate': 'no_rotate.csv', 'identical': 'same.csv',
+              'rotated': 'rotated_need_reannotate.csv',
+              'revcomp': 'rotated_need_reannotate.csv',
+              'different': 'rotated_need_reannotate.csv'}
+
+
+def parse_args():
+    arg = argparse.ArgumentParser(description=main.__doc__)
+    arg.add_argument('input', nargs='+',
+                     help='genbank files or folders of genbank files')
+    arg.add_argument('-jobs', type=int, default=cpu_count(),
+                     help='number of processes')
+    arg.add_argument('-out', default='rotation.csv',
+                     help='output table of all files')
+    return arg.parse_args()
+
+
+def least_rotation(seq: bytes) -> int:
+    """
+    Booth's algorithm, O(n).
+    Return:
+        start of the lexicographically minimal rotation
+    """
+    double = seq + seq
+    failure = [-1] * len(double)
+    k = 0
+    for j in range(1, len(double)):
+        char = double[j]
+        i = failure[j-k-1]
+        while i != -1 and char != double[k+i+1]:
+            if char < double[k+i+1]:
+                k = j - i - 1
+            i = failure[i]
+        if char != double[k+i+1]:
+            # i == -1
+            if char < double[k]:
+                k = j
+            failure[j-k] = -1
+        else:
+            failure[j-k] = i + 1
+    return k
+
+
+def get_canonical(seq: bytes) -> bytes:
+    # canonical form of circular sequence
+    k = least_rotation(seq)
+    return seq[k:] + seq[:k]
+
+
+def reverse_complement(seq: bytes) -> bytes:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def classify(raw: bytes, rotated: bytes) -> str:
+    """
+    Compare two circular sequences.
+    Return:
+        identical, rotated, revcomp (reverse complement with or without
+        rotation) or different
+    """
+    raw = raw.upper()
+    rotated = rotated.upper()
+    if raw == rotated:
+        return 'identical'
+    if len(raw) != len(rotated):
+        return 'different'
+    canonical = get_canonical(raw)
+    if canonical == get_canonical(rotated):
+        return 'rotated'
+    if canonical == get_canonical(reverse_complement(rotated)):
+        return 'revcomp'
+    return 'different'
+
+
+def check(raw_gb: Path) -> tuple[Path, str]:
+    """
+    Compare genbank file with rotated fasta in "{gb}-out/{gb}.fasta".
+    Return:
+        raw_gb(Path): genbank file
+        status(str): no_rotate or result of classify
+    """
+    rotated_fasta = raw_gb.with_name(raw_gb.name+'-out') / (
+        raw_gb.name+'.fasta')
+    if not rotated_fasta.exists():
+        return raw_gb, 'no_rotate'
     raw = SeqIO.read(raw_gb, 'gb')
     rotated = SeqIO.read(rotated_fasta, 'fasta')
-    if hash(raw.seq) == hash(rotated.seq):
-        same.write(argv[1]+'\n')
-    else:
-        rotated_need_reannotate.write(argv[1]+'\n')
+    return raw_gb, classify(bytes(raw.seq), bytes(rotated.seq))
+
+
+def get_gb(inputs) -> list:
+    gb_files = []
+    for i in inputs:
+        i = Path(i)
+        if i.is_dir():
+            gb_files.extend(sorted(i.glob('*.gb')))
+        else:
+            gb_files.append(i)
+    return gb_files
+
+
+def main():
+    """
+    Check if genomes are rotated, by canonical rotation of both strands.
+    """
+    arg = parse_args()
+    gb_files = get_gb(arg.input)
+    old_output = {i: open(i, 'a') for i in set(OLD_OUTPUT.values())}
+    count = dict()
+    with open(arg.out, 'a') as out, Pool(max(1, arg.jobs)) as pool:
+        for raw_gb, status in pool.imap(check, gb_files, chunksize=4):
+            old_output[OLD_OUTPUT[status]].write(str(raw_gb)+'\n')
+            out.write(f'{raw_gb},{status}\n')
+            count[status] = count.get(status, 0) + 1
+    for handle in old_output.values():
+        handle.close()
+    for status, n in sorted(count.items()):
+        print(f'{status}: {n}')
+
+
+if __name__ == '__main__':
+    main()
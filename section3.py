@@ -1,10 +1,19 @@
 #!/usr/bin/python3
 
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib import sha256
 from multiprocessing import Pool
 from pathlib import Path
+from shutil import copyfileobj
 from subprocess import run
-from sys import argv
+from time import time
+import argparse
+import json
 import logging
+import os
+
+from align_scheduler import AlignCache, AlignJob, CoreBudget, run_jobs
 
 
 FMT = '%(asctime)s %(levelname)-8s %(message)s'
@@ -16,25 +25,83 @@ logging.basicConfig(format=FMT, datefmt=DATEFMT, level=logging.INFO,
 import coloredlogs
 coloredlogs.install(level=logging.INFO, fmt=FMT, datefmt=DATEFMT)
 log = logging.getLogger()
+# reuse alignments of unchanged input
+ALN_CACHE = Path('~/analyze/align_cache').expanduser()
+FOLDERS = ('all_family', 'all_genus', 'all_species', 'all_sample')
+STAGES = ('copy', 'divide', 'align', 'align_to_ref', 'evaluate')
+
+
+def append_file(src, out):
+    """
+    Append src to opened binary file out, by copy_file_range in kernel if
+    possible.
+    """
+    with open(src, 'rb') as raw:
+        size = os.fstat(raw.fileno()).st_size
+        offset = 0
+        # data of fallback copy may be still in buffer
+        out.flush()
+        try:
+            while offset < size:
+                n = os.copy_file_range(raw.fileno(), out.fileno(),
+                                       size-offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except (AttributeError, OSError):
+            # old python/kernel or different filesystem
+            raw.seek(offset)
+            out.seek(0, os.SEEK_END)
+            copyfileobj(raw, out, 1 << 24)
+    return size
 
 
-def copy_():
+def copy_(list_file):
+    """
+    Concatenate genbank files of accessions in list_file into
+    {stem}/{stem}.gb. Raw files are found by prefix from one sorted index of
+    raw folder.
+    Raise RuntimeError if any file cannot be copied, old output is kept.
+    """
     folder = Path('./raw-newest')
-    dest = Path(Path(argv[1]).stem)
+    dest = Path(Path(list_file).stem)
+    dest.mkdir(exist_ok=True)
+    out_file = dest / f'{dest.name}.gb'
+    # one scan of raw folder
+    names = sorted(i.name for i in os.scandir(folder))
     bad = []
-    with open(argv[1], 'r') as _:
+    missing = []
+    n = 0
+    total = 0
+    # write complete list every time, replace old file only if finished
+    tmp_file = out_file.with_suffix('.gb.tmp')
+    with open(tmp_file, 'wb') as out, open(list_file, 'r') as _:
         for line in _:
+            accession = line.strip()
+            if not accession:
+                continue
+            index = bisect_left(names, accession)
+            if index == len(names) or not names[index].startswith(accession):
+                missing.append(accession)
+                continue
+            f = folder / names[index]
             try:
-                f = list(folder.glob(line.strip()+'*'))[0]
-                cmd = f'cat "{f}" >> {dest/dest.name}.gb'
-                print(cmd)
-                r = run(cmd, shell=True)
-                if r.returncode != 0:
-                    bad.append(cmd)
-
-            except IndexError:
-                pass
-    return bad
+                total += append_file(f, out)
+                n += 1
+            except OSError as e:
+                log.error(f'Cannot copy {f}: {e}')
+                bad.append(str(f))
+    if missing:
+        missing_file = out_file.with_suffix('.missing')
+        missing_file.write_text('\n'.join(missing)+'\n')
+        log.warning(f'{len(missing)} accessions not found in {folder}, see '
+                    f'{missing_file}.')
+    if bad:
+        # keep old output, pipeline would not record failed copy
+        tmp_file.unlink()
+        raise RuntimeError(f'Failed to copy {len(bad)} files to {out_file}')
+    tmp_file.replace(out_file)
+    log.info(f'Copied {n} files ({total} bytes) to {out_file}.')
 
 
 def run_cmd(f):
@@ -49,93 +116,89 @@ def run_cmd(f):
     return r.returncode
 
 
-def divide():
-    folders = ('all_species', 'all_family', 'all_genus', 'all_sample')
-    pool = Pool()
-    with Pool() as pool:
-        pool.map(run_cmd, folders)
-        # apply_async()
-        # pool.close()
-        # pool.join()
+def divide(folder):
+    # folders are divided concurrently by pipeline runner
+    if run_cmd(folder) != 0:
+        raise RuntimeError(f'Failed to divide {folder}')
     print('divide done')
 
 
-def align():
-    folders = ('all_family', 'all_genus', 'all_species', 'all_sample')
-    new_folders = [Path(i+'_divide')/'Unique' for i in folders]
+def check_jobs(jobs, bad_file):
+    """
+    Write failed jobs to bad_file and remove their incomplete output.
+    Raise RuntimeError if any job failed, so pipeline would not record it.
+    """
+    bad = open(bad_file, 'w')
+    n_bad = 0
+    for job in jobs:
+        if job.returncode != 0:
+            bad.write(str(job.fasta)+'\n')
+            job.out.unlink(missing_ok=True)
+            n_bad += 1
+    bad.close()
+    log.info(f'Total {len(jobs)}')
+    log.info(f'Bad {n_bad}')
+    if n_bad:
+        raise RuntimeError(f'{n_bad} alignments failed, see {bad_file}')
+
+
+def align(folder, budget=None):
+    name = folder
+    folder = Path(folder+'_divide') / 'Unique'
     skip = ('gene-rps12', )
-    for folder in new_folders:
-        log.info(f'Folder {folder}')
-        fasta = list(folder.glob('*.uniq'))
-        log.info(f'{len(fasta)} files')
-        bad = open(folder.stem+'_bad.txt', 'w')
-        n = 0
-        n_bad = 0
-        for fas in fasta:
-            n += 1
-            log.info(fas.name)
-            if skip[0] in fas.name:
-                log.warning(f'Skip {fas}')
-            cmd = (f'mafft --reorder --adjustdirection --thread 15 '
-                   f'--genafpair --maxiterate 1000 '
-                   f'{fas} > {fas.with_suffix(".aln")}')
-            r = run(cmd, shell=True)
-            if r.returncode != 0:
-                bad.write(str(fas)+'\n')
-                log.warning(f'{fas} failed.')
-                n_bad += 1
-        log.info(f'Total {n}')
-        log.info(f'Bad {n_bad}')
-
-
-def align_to_ref():
-    folders = ('all_genus', 'all_species', 'all_sample')
+    cache = AlignCache(ALN_CACHE)
+    log.info(f'Folder {folder}')
+    fasta = list(folder.glob('*.uniq'))
+    log.info(f'{len(fasta)} files')
+    jobs = []
+    for fas in fasta:
+        log.info(fas.name)
+        if skip[0] in fas.name:
+            log.warning(f'Skip {fas}')
+        jobs.append(AlignJob(fas, fas.with_suffix('.aln'), options=(
+            '--reorder', '--adjustdirection', '--genafpair',
+            '--maxiterate', '1000')))
+    run_jobs(jobs, cache=cache, budget=budget)
+    check_jobs(jobs, f'{name}_align_bad.txt')
+
+
+def align_to_ref(folder, budget=None):
     ref_ = Path('all_family_divide') / 'Alignment'
     ref = list(ref_.glob('*.fasta'))
     ref_dict = {i.stem: i for i in ref}
 
-    new_folders = [Path(i+'_divide')/'Unique' for i in folders]
+    name = folder
+    folder = Path(folder+'_divide') / 'Unique'
+    # keep alignments of align stage
+    out_folder = folder.with_name('Align_to_ref')
+    out_folder.mkdir(exist_ok=True)
     skip = ('gene-rps12', 'CDS-ycf1', 'CDS-ycf2')
     # hard to align
     # hard = ('gene-ycf1', 'gene-ycf2')
-    for folder in new_folders:
-        log.info(f'Folder {folder}')
-        if 'all_genus' in str(folder.name):
-            fasta = list(folder.glob('*.uniq'))
+    options = ('--reorder', '--adjustdirection', '--auto')
+    cache = AlignCache(ALN_CACHE)
+    log.info(f'Folder {folder}')
+    if 'all_genus' in str(folder.parent.name):
+        fasta = list(folder.glob('*.uniq'))
+    else:
+        fasta = list(folder.glob('spacer*.uniq'))
+    log.info(f'{len(fasta)} files')
+    jobs = []
+    for fas in fasta:
+        out = out_folder / fas.with_suffix('.aln').name
+        log.info(fas.name)
+        if fas.stem in skip:
+            log.warning(f'Skip {fas}')
+            continue
+        if fas.stem in ref_dict:
+            ref_fasta = ref_dict[fas.stem]
+            log.info(f'Use ref {ref_fasta} to align {fas}')
+            # f'--thread 15 --genafpair --maxiterate 1000 '
+            jobs.append(AlignJob(fas, out, options, ref=ref_fasta))
         else:
-            fasta = list(folder.glob('spacer*.uniq'))
-        log.info(f'{len(fasta)} files')
-        bad = open(folder.stem+'_bad.txt', 'w')
-        n = 0
-        n_bad = 0
-        for fas in fasta:
-            out = fas.with_suffix('.aln')
-            if out.exists():
-                log.warning(f'Skip existing file {out}')
-                continue
-            n += 1
-            log.info(fas.name)
-            if fas.stem in skip:
-                log.warning(f'Skip {fas}')
-                continue
-            if fas.stem in ref_dict:
-                ref_fasta = ref_dict[fas.stem]
-                log.info(f'Use ref {ref_fasta} to align {fas}')
-                cmd = (f'mafft --add {fas} --reorder --adjustdirection '
-                       # f'--thread 15 --genafpair --maxiterate 1000 '
-                       f'--auto --thread 15'
-                       f'{ref_fasta} > {fas.with_suffix(".aln")}')
-            else:
-                cmd = (f'mafft --reorder --adjustdirection --thread 15 '
-                       f'--auto --thread 15'
-                       f'{fas} > {fas.with_suffix(".aln")}')
-            r = run(cmd, shell=True)
-            if r.returncode != 0:
-                bad.write(str(fas)+'\n')
-                log.warning(f'{fas} failed.')
-                n_bad += 1
-        log.info(f'Total {n}')
-        log.info(f'Bad {n_bad}')
+            jobs.append(AlignJob(fas, out, options))
+    run_jobs(jobs, cache=cache, budget=budget)
+    check_jobs(jobs, f'{name}_align_to_ref_bad.txt')
 
 
 def run_evaluate(f):
@@ -154,6 +217,205 @@ def evaluate():
     # skip ycf1 and ycf2
     files = [i for i in folder.glob('*.fasta') if i.name in ref_set]
     with Pool(15) as pool:
-        pool.map(run_evaluate, files)
+        codes = pool.map(run_evaluate, files)
+    failed = [f for f, code in zip(files, codes) if code != 0]
+    for f in failed:
+        log.error(f'Failed to evaluate {f}')
+    log.info(f'Total {len(files)}')
+    log.info(f'Bad {len(failed)}')
+    if failed:
+        raise RuntimeError(f'{len(failed)} evaluations failed')
+
+
+class Target:
+    """
+    One stage of one folder in pipeline.
+    inputs and outputs are glob patterns. Target is finished if all outputs
+    exist and inputs are same as the last successful run in journal.
+    """
+    def __init__(self, name, func, args=(), deps=(), inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.outputs = outputs
+
+    @staticmethod
+    def expand(pattern) -> list:
+        pattern = Path(pattern).expanduser()
+        if not pattern.is_absolute():
+            pattern = Path.cwd() / pattern
+        return sorted(Path(pattern.anchor).glob(
+            str(pattern.relative_to(pattern.anchor))))
+
+    def signature(self) -> str:
+        # size and mtime of inputs
+        key = sha256()
+        for pattern in self.inputs:
+            for f in self.expand(pattern):
+                stat = f.stat()
+                line = f'{f}\t{stat.st_size}\t{stat.st_mtime_ns}\n'
+                key.update(line.encode())
+        return key.hexdigest()
+
+    def finished(self) -> bool:
+        return all(self.expand(i) for i in self.outputs)
+
+
+def get_targets(lists, folders, budget=None) -> list:
+    """
+    Declare stages, their inputs, outputs and dependencies.
+    Alignments of all targets share the cores of budget.
+    """
+    if budget is None:
+        budget = CoreBudget()
+    targets = []
+    for list_file in lists:
+        name = Path(list_file).stem
+        targets.append(Target(f'copy:{name}', copy_, (list_file, ),
+                              inputs=[list_file],
+                              outputs=[f'{name}/{name}.gb']))
+    for folder in folders:
+        unique = f'{folder}_divide/Unique'
+        targets.append(Target(f'divide:{folder}', divide, (folder, ),
+                              deps=[f'copy:{folder}'],
+                              inputs=[f'{folder}/{folder}.gb'],
+                              outputs=[f'{unique}/*.uniq']))
+        targets.append(Target(f'align:{folder}', align, (folder, budget),
+                              deps=[f'divide:{folder}'],
+                              inputs=[f'{unique}/*.uniq'],
+                              outputs=[f'{unique}/*.aln']))
+        # Alignment folders are prepared outside of pipeline, only tracked
+        # as inputs
+        if folder != 'all_family':
+            targets.append(Target(
+                f'align_to_ref:{folder}', align_to_ref, (folder, budget),
+                deps=[f'divide:{folder}'],
+                inputs=[f'{unique}/*.uniq',
+                        'all_family_divide/Alignment/*.fasta'],
+                outputs=[f'{folder}_divide/Align_to_ref/*.aln']))
+    targets.append(Target(
+        'evaluate', evaluate,
+        inputs=['~/analyze/all_genus_divide/Alignment/*.fasta',
+                '~/analyze/all_family_divide/Alignment/*.fasta'],
+        outputs=['~/analyze/all_genus_divide/Evaluate/*-out']))
+    return targets
+
+
+def load_journal(journal) -> dict:
+    # target name: input signature of last successful run
+    finished = dict()
+    if not journal.exists():
+        return finished
+    with open(journal, 'r') as raw:
+        for line in raw:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # incomplete line of crash
+                continue
+            finished[record['target']] = record['signature']
+    return finished
+
+
+def run_pipeline(targets, journal, jobs=2, force=False) -> dict:
+    """
+    Run targets after their dependencies, skip finished targets according to
+    journal, independent targets run concurrently.
+    Each successful target is appended to journal at once, so the pipeline
+    could resume after failure.
+    Return: target name: status
+    """
+    names = set(i.name for i in targets)
+    # dependencies not selected are regarded as finished
+    for target in targets:
+        target.deps = [i for i in target.deps if i in names]
+    finished = dict() if force else load_journal(journal)
+    status = dict()
+    pending = list(targets)
+    running = dict()
+    with ThreadPoolExecutor(jobs) as executor, open(journal, 'a') as out:
+        while pending or running:
+            changed = False
+            for target in list(pending):
+                dep_status = [status.get(i) for i in target.deps]
+                if None in dep_status:
+                    continue
+                pending.remove(target)
+                changed = True
+                if any(i != 'ok' for i in dep_status):
+                    log.warning(f'Skip {target.name} due to failed '
+                                f'dependencies.')
+                    status[target.name] = 'skipped'
+                    continue
+                signature = target.signature()
+                if (finished.get(target.name) == signature and
+                        target.finished()):
+                    log.info(f'{target.name} is up to date.')
+                    status[target.name] = 'ok'
+                    continue
+                log.info(f'Start {target.name}')
+                future = executor.submit(target.func, *target.args)
+                running[future] = (target, signature, time())
+            if not running:
+                if not changed:
+                    log.error('Bad dependencies of '
+                              f'{[i.name for i in pending]}')
+                    break
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                target, signature, start = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    log.exception(f'{target.name} failed.')
+                    status[target.name] = 'failed'
+                    continue
+                status[target.name] = 'ok'
+                log.info(f'{target.name} done in {time()-start:.1f}s.')
+                out.write(json.dumps({'target': target.name,
+                                      'signature': signature,
+                                      'time': time()})+'\n')
+                out.flush()
+    return status
+
+
+def parse_args():
+    arg = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=main.__doc__)
+    arg.add_argument('-stages', nargs='*', choices=STAGES,
+                     default=['evaluate'], help='stages to run')
+    arg.add_argument('-folders', nargs='*', default=FOLDERS,
+                     help='folders to analyze')
+    arg.add_argument('-lists', nargs='*', default=[],
+                     help='accession list files for copy stage')
+    arg.add_argument('-jobs', type=int, default=2,
+                     help='number of targets run concurrently')
+    arg.add_argument('-cores', type=int,
+                     help='total cores of alignments, default is all but '
+                     'one')
+    arg.add_argument('-journal', default='section3.journal',
+                     help='checkpoint journal')
+    arg.add_argument('-force', action='store_true',
+                     help='ignore journal and rerun all selected targets')
+    return arg.parse_args()
+
+
+def main():
+    """
+    Pipeline of section 3, could resume from journal.
+    """
+    arg = parse_args()
+    budget = CoreBudget(arg.cores)
+    targets = [i for i in get_targets(arg.lists, arg.folders, budget)
+               if i.name.split(':')[0] in arg.stages]
+    status = run_pipeline(targets, Path(arg.journal), arg.jobs, arg.force)
+    for name, result in status.items():
+        log.info(f'{name}\t{result}')
+
 
-evaluate()
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,296 @@
 #!/usr/bin/python3
 
 import argparse
+import bz2
+import gzip
 import os
+from multiprocessing import Pool, cpu_count
+from shutil import copyfileobj
 from timeit import default_timer as timer
-from Bio import SeqIO
+
+import numpy as np
+
+# size of chunk to read
+CHUNK_SIZE = 1 << 24
+NEWLINE = ord('\n')
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+OPEN = {'gz': gzip.open, 'bz2': bz2.open}
+
+
+def open_input(filename):
+    """
+    Open plain, gzip or bzip2 file in binary mode, by magic bytes.
+    """
+    with open(filename, 'rb') as raw:
+        magic = raw.read(3)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(filename, 'rb')
+    elif magic == b'BZh':
+        return bz2.open(filename, 'rb')
+    else:
+        return open(filename, 'rb')
 
 
 def get_format(filename):
-    with open(filename, 'r') as raw:
+    with open_input(filename) as raw:
         line = raw.readline()
-        if line.startswith('>'):
+        if line.startswith(b'>'):
             return 'fasta'
-        elif line.startswith('@'):
+        elif line.startswith(b'@'):
             return 'fastq'
         else:
             raise ValueError('Unsupport format!')
 
 
-def split(fasta, size, out, file_format):
-    raw = SeqIO.parse(fasta, file_format)
+def compress_file(filename, method) -> str:
+    """
+    Compress file to filename.method and remove the original one.
+    """
+    compressed = '{}.{}'.format(filename, method)
+    with open(filename, 'rb') as raw, OPEN[method](
+            compressed, 'wb', compresslevel=6) as out:
+        copyfileobj(raw, out, CHUNK_SIZE)
+    os.remove(filename)
+    return compressed
+
+
+def get_starts(data, file_format, eof) -> tuple[np.array, int]:
+    """
+    Find records in data, data starts with a record.
+    Fasta records start with ">" at the beginning of line, fastq records
+    are blocks of 4 lines.
+    Return:
+        starts(np.array): offset of complete records
+        end(int): end of last complete record
+    """
+    array = np.frombuffer(data, dtype=np.uint8)
+    if file_format == 'fasta':
+        starts = np.flatnonzero((array[:-1] == NEWLINE) &
+                                (array[1:] == ord('>'))) + 1
+        starts = np.concatenate(([0], starts))
+        if eof:
+            end = len(data)
+        else:
+            end = int(starts[-1])
+            starts = starts[:-1]
+    else:
+        ends = (np.flatnonzero(array == NEWLINE) + 1)[3::4]
+        starts = np.concatenate(([0], ends[:-1]))[:len(ends)]
+        end = int(ends[-1]) if len(ends) else 0
+        if eof and data[end:].strip():
+            # last record without line break
+            starts = np.append(starts, end)
+            end = len(data)
+    return starts, end
+
+
+def iter_blocks(handle, file_format, chunk_size=None):
+    """
+    Read large blocks of whole records, without parsing.
+    Args:
+        handle: file opened in binary mode
+        file_format(str): fasta or fastq
+    Yield:
+        block(bytes): whole records
+        starts(np.array): offset of each record in block
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    rest = b''
+    first = True
+    while True:
+        data = handle.read(chunk_size)
+        eof = not data
+        data = rest + data
+        if first and file_format == 'fasta' and not data.startswith(b'>'):
+            # skip text before the first record, like SeqIO
+            start = data.find(b'\n>')
+            if start == -1:
+                rest = b'' if eof else data[-1:]
+                if eof:
+                    return
+                continue
+            data = data[start+1:]
+        first = False
+        if not data:
+            return
+        starts, end = get_starts(data, file_format, eof)
+        if len(starts):
+            yield data[:end], starts
+        rest = data[end:]
+        if eof:
+            return
+
+
+def get_byte_size(size) -> int:
+    # 100M -> 104857600
+    if size is None:
+        return None
+    size = size.upper().rstrip('B')
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def get_name(header) -> bytes:
+    # "@read1/1 comment" -> "read1"
+    name = header.split(None, 1)
+    name = name[0][1:] if name else b''
+    if name.endswith((b'/1', b'/2')):
+        name = name[:-2]
+    return name
+
+
+def check_names(block1, bounds1, i1, block2, bounds2, i2, k):
+    """
+    Check read names of k pairs of records.
+    """
+    for t in range(k):
+        start1 = bounds1[i1+t]
+        start2 = bounds2[i2+t]
+        name1 = get_name(block1[start1:block1.find(b'\n', start1)])
+        name2 = get_name(block2[start2:block2.find(b'\n', start2)])
+        if name1 != name2:
+            raise ValueError('Read names do not match: {} and {}.'.format(
+                name1.decode(), name2.decode()))
+
+
+def get_out_name(fasta) -> str:
+    # ss.fa.gz -> ss.fa
+    for suffix in ('.gz', '.bz2'):
+        if fasta.endswith(suffix):
+            return fasta[:-len(suffix)]
+    return fasta
+
+
+def split(fasta, size, out, file_format, byte_size=None, compress=None,
+          pool=None, fasta2=None, head=None):
+    """
+    Copy whole records to files of given number of records, or of given
+    bytes (at least one record in each file).
+    Records are written as they are, lines are not wrapped again.
+    Finished files are compressed in pool if compress is given.
+    If fasta2 is given, read two files in lockstep and write pairs of
+    files with same reads, names of reads are checked.
+    Args:
+        fasta(str): input file, could be gzip or bzip2 file
+        size(int): number of records in each file
+        out(str): output folder
+        file_format(str): fasta or fastq
+        byte_size(int): maximum bytes of each file before compression,
+        override size, for paired files only count the first file
+        compress(str): None, gz or bz2
+        pool(Pool): process pool for compression
+        fasta2(str): second file of paired reads
+        head(int): only use the first head records (pairs)
+    Return:
+        n_files(int): number of output files (pairs)
+    """
+    inputs = [fasta] if fasta2 is None else [fasta, fasta2]
+    names = [get_out_name(i) for i in inputs]
+    n_files = 0
+    outputs = None
+    count = 0
+    total = 0
+    written = 0
+    results = []
 
-    def newfile(index):
-        output = open(os.path.join(
-            out, '{}.{}'.format(fasta, (index//size)+1)), 'w')
-        return output
+    def close():
+        for output in outputs:
+            output.close()
+            if compress is not None:
+                results.append(pool.apply_async(compress_file,
+                                                (output.name, compress)))
 
-    for index, record in enumerate(raw, 1):
-        if index % size == 1:
-            output = newfile(index)
-        SeqIO.write(record, output, file_format)
-    return
+    raws = [open_input(i) for i in inputs]
+    blocks = [iter_blocks(i, file_format) for i in raws]
+    # [block, bounds, next record]
+    cursors = [[b'', np.zeros(1, dtype=np.int64), 0] for i in inputs]
+    try:
+        while head is None or total < head:
+            for cursor, block_iter in zip(cursors, blocks):
+                if cursor[2] == len(cursor[1]) - 1:
+                    block, starts = next(block_iter, (b'', []))
+                    cursor[:] = block, np.append(starts, len(block)), 0
+            available = [len(bounds)-1-i for _, bounds, i in cursors]
+            if min(available) == 0:
+                if max(available) != 0:
+                    raise ValueError('Paired files have different number '
+                                     'of records.')
+                break
+            block, bounds, i = cursors[0]
+            limit = i + min(available)
+            if head is not None:
+                limit = min(limit, i+head-total)
+            if outputs is None:
+                n_files += 1
+                outputs = [open(os.path.join(
+                    out, '{}.{}'.format(name, n_files)), 'wb')
+                    for name in names]
+                count = 0
+                written = 0
+            if byte_size is not None:
+                target = bounds[i] + byte_size - written
+                end = int(np.searchsorted(bounds, target, side='right')) - 1
+                j = min(end, limit)
+                if j <= i:
+                    if written:
+                        close()
+                        outputs = None
+                        continue
+                    j = i + 1
+                full = end < limit or written+bounds[j]-bounds[i] >= byte_size
+            else:
+                j = min(limit, i+size-count)
+                full = count + j - i >= size
+            k = j - i
+            if fasta2 is not None:
+                block2, bounds2, i2 = cursors[1]
+                check_names(block, bounds, i, block2, bounds2, i2, k)
+                outputs[1].write(memoryview(block2)[bounds2[i2]:
+                                                    bounds2[i2+k]])
+                cursors[1][2] += k
+            outputs[0].write(memoryview(block)[bounds[i]:bounds[j]])
+            cursors[0][2] = j
+            count += k
+            total += k
+            written += int(bounds[j] - bounds[i])
+            if full:
+                close()
+                outputs = None
+        if outputs is not None:
+            close()
+            outputs = None
+    finally:
+        for raw in raws:
+            raw.close()
+        # chunk files left open by error
+        if outputs is not None:
+            for output in outputs:
+                output.close()
+    for result in results:
+        result.get()
+    return n_files
 
 
 def parse_args():
     arg = argparse.ArgumentParser()
     arg.add_argument('-i', '--input', required=True, help='input file')
+    arg.add_argument('-i2', '--input2',
+                     help='second file of paired reads, split with input '
+                     'in lockstep')
     arg.add_argument('-s', '--size', type=int, default=100000,
                      help='how many sequences one file have')
+    arg.add_argument('-b', '--byte_size',
+                     help='maximum size of one file, e.g. 100M, 2G, '
+                     'override -s')
+    arg.add_argument('-head', type=int,
+                     help='only use the first N sequences (pairs)')
     arg.add_argument('-o', '--out', help='output directory')
+    arg.add_argument('-compress', choices=('gz', 'bz2'),
+                     help='compress output files')
+    arg.add_argument('-jobs', type=int, default=cpu_count(),
+                     help='number of processes for compression')
     arg.print_help()
     return arg.parse_args()
 
@@ -47,10 +300,16 @@ def main():
     arg = parse_args()
 
     file_format = get_format(arg.input)
+    if arg.input2 is not None and get_format(arg.input2) != file_format:
+        raise ValueError('Paired files have different formats!')
     if arg.out is None:
         arg.out = 'out_{}'.format(arg.input)
     os.mkdir(arg.out)
-    split(arg.input, arg.size, arg.out, file_format)
+    with Pool(max(1, arg.jobs)) as pool:
+        n_files = split(arg.input, arg.size, arg.out, file_format,
+                        get_byte_size(arg.byte_size), arg.compress, pool,
+                        arg.input2, arg.head)
+    print('Split into {} files.'.format(n_files))
     # end
     end = timer()
     print('Cost {:3f}s.\n'.format(end-start))
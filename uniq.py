@@ -1,18 +1,46 @@
 #!/usr/bin/python3
 
 from Bio import SeqIO
+from copy import copy
+from glob import glob
+from hashlib import blake2b
+from heapq import merge
+from itertools import groupby
+from multiprocessing import Pool, cpu_count
+from tempfile import TemporaryFile
 from timeit import default_timer as timer
 import argparse
 import re
 
+# number of member ids kept in memory before spilling to disk
+RUN_SIZE = 1_000_000
+WHITESPACE = b' \t\r\n\x0b\x0c'
+# not counted in length of sequence
+SKIP = WHITESPACE + b'Nn'
+# size of chunk to read
+CHUNK_SIZE = 1 << 24
+
 
 def parse_args():
     args = argparse.ArgumentParser(description=main.__doc__)
-    args.add_argument('input', help='input file as fasta format')
+    args.add_argument('input', nargs='+',
+                      help='input files or patterns as fasta format')
     args.add_argument('-c', type=str, dest='choice',
                       help='the field you want to use')
     args.add_argument('-m', '--method', default='longest',
-                      help='method to get the only sequence')
+                      choices=('longest', 'hash'),
+                      help='method to get the only sequence, "longest" for '
+                      'the longest sequence of same fields, "hash" for '
+                      'identical sequences')
+    args.add_argument('-ignore_case', action='store_true',
+                      help='ignore case of sequence in hash method')
+    args.add_argument('-ignore_gap', action='store_true',
+                      help='ignore gap ("-") in hash method')
+    args.add_argument('-seqio', action='store_true',
+                      help='use SeqIO records instead of the fast '
+                      'streaming method, slow')
+    args.add_argument('-jobs', type=int, default=cpu_count(),
+                      help='number of processes for multiple files')
     args.print_help()
     return args.parse_args()
 
@@ -81,6 +109,266 @@ def uniq(args, sep):
     print('{} sequences left in the file {}.uniq.'.format(after, args.input))
     log.close()
     output.close()
+    return before, after
+
+
+def read_fasta(handle):
+    """
+    Read fasta like SeqIO, but in bytes and record offset.
+    Args:
+        handle: fasta file opened in binary mode
+    Yield:
+        offset(int): offset of title line
+        title(bytes): title without ">"
+        sequence(bytes): sequence without whitespace
+    """
+    offset = 0
+    title = None
+    lines = []
+    title_offset = 0
+    for line in handle:
+        if line.startswith(b'>'):
+            if title is not None:
+                yield title_offset, title, b''.join(lines).replace(
+                    b' ', b'').replace(b'\r', b'')
+            title = line[1:].rstrip()
+            title_offset = offset
+            lines = []
+        elif title is not None:
+            lines.append(line.rstrip())
+        offset += len(line)
+    if title is not None:
+        yield title_offset, title, b''.join(lines).replace(
+            b' ', b'').replace(b'\r', b'')
+
+
+def scan_fasta(handle, chunk_size=CHUNK_SIZE):
+    """
+    Read large chunks and split records at "\\n>" instead of lines.
+    Args:
+        handle: fasta file opened in binary mode
+    Yield:
+        offset(int): offset of title line
+        title(bytes): title without ">"
+        body(bytes): raw sequence lines, with whitespace
+    """
+    # offset of data in file
+    offset = 0
+    data = b''
+    started = False
+    while True:
+        chunk = handle.read(chunk_size)
+        data += chunk
+        if not started:
+            # skip text before the first record
+            start = 0 if data.startswith(b'>') else data.find(b'\n>') + 1
+            if start == 0 and not data.startswith(b'>'):
+                if not chunk:
+                    return
+                offset += len(data) - 1
+                data = data[-1:]
+                continue
+            offset += start
+            data = data[start:]
+            started = True
+        # end of last complete record
+        end = len(data) if not chunk else data.rfind(b'\n>') + 1
+        if end > 0:
+            record_offset = offset
+            for record in data[1:end].split(b'\n>'):
+                line_end = record.find(b'\n')
+                if line_end == -1:
+                    yield record_offset, record.rstrip(), b''
+                else:
+                    yield (record_offset, record[:line_end].rstrip(),
+                           record[line_end:])
+                # ">" and "\n"
+                record_offset += len(record) + 2
+            offset += end
+            data = data[end:]
+        if not chunk:
+            return
+
+
+def read_record(handle, offset) -> tuple[bytes, bytes]:
+    # read one record at given offset
+    handle.seek(offset)
+    for _, title, sequence in read_fasta(handle):
+        return title, sequence
+
+
+def format_fasta(title, sequence) -> bytes:
+    # same as SeqIO.write
+    title = title.replace(b'\r', b' ')
+    lines = [b'>' + title]
+    lines.extend(sequence[i:i+60] for i in range(0, len(sequence), 60))
+    return b'\n'.join(lines) + b'\n'
+
+
+def spill(buffer, runs):
+    # write sorted run of (group, index, id) to temporary file
+    buffer.sort()
+    run = TemporaryFile('w+')
+    for group, index, id_ in buffer:
+        run.write(f'{group}\t{index}\t{id_.decode()}\n')
+    run.seek(0)
+    runs.append(run)
+    buffer.clear()
+
+
+def read_run(run):
+    for line in run:
+        group, index, id_ = line.rstrip('\n').split('\t', 2)
+        yield int(group), int(index), id_
+
+
+def uniq_stream(args, sep):
+    """
+    Streaming version of uniq, output is same.
+    Read fasta as bytes, for each name only keep length and offset of the
+    longest sequence, then read them again to write. Ids of sequences for
+    log are sorted on disk.
+    """
+    if args.choice is None:
+        args.choice = get_choice(args.input, sep)
+    choice = {int(i)-1 for i in args.choice.split(' ')}
+    sep = re.compile(sep.pattern.encode())
+    # name: [group, length, offset, id, count]
+    name_best = dict()
+    buffer = []
+    runs = []
+    before = 0
+    after = 0
+    with open(args.input, 'rb') as raw:
+        for offset, title, body in scan_fasta(raw):
+            length = len(body.translate(None, SKIP))
+            id_ = title.split(None, 1)
+            id_ = id_[0] if id_ else b''
+            name = b'.'.join([item for index, item in enumerate(
+                sep.split(id_)) if index in choice])
+            if name not in name_best:
+                name_best[name] = [len(name_best), length, offset, id_, 1]
+            else:
+                best = name_best[name]
+                best[4] += 1
+                # keep the first one if same length
+                if length > best[1]:
+                    best[1:4] = length, offset, id_
+            buffer.append((name_best[name][0], before, id_))
+            if len(buffer) >= RUN_SIZE:
+                spill(buffer, runs)
+            before += 1
+        spill(buffer, runs)
+
+        print('Duplicated sequences:')
+        log = open(args.input+'.log', 'w')
+        output = open(args.input+'.uniq', 'wb')
+        members = groupby(merge(*[read_run(i) for i in runs]),
+                          key=lambda x: x[0])
+        for (_, _, offset, longest, count), (_, group) in zip(
+                name_best.values(), members):
+            after += 1
+            output.write(format_fasta(*read_record(raw, offset)))
+            if count != 1:
+                id_list = [i[2] for i in group]
+                log.write('Longest:\t{} in ({})\n'.format(
+                    longest.decode(), '\t'.join(id_list)))
+    for run in runs:
+        run.close()
+    log.write('Before\tAfter\n')
+    log.write('{}\t\t{}\n'.format(before, after))
+    print('Total {} sequences in {} format.'.format(before, 'fasta'))
+    print('{} sequences left in the file {}.uniq.'.format(after, args.input))
+    log.close()
+    output.close()
+    return before, after
+
+
+def uniq_hash(args):
+    """
+    Collapse identical sequences by blake2b digest, the first one is kept.
+    Only digest, offset and id of the first sequence are kept in memory.
+    All members of each representative are written to .map for restore.
+    """
+    delete = WHITESPACE + (b'-' if args.ignore_gap else b'')
+    # digest: [group, offset, id, count]
+    seq_first = dict()
+    buffer = []
+    runs = []
+    before = 0
+    after = 0
+    with open(args.input, 'rb') as raw:
+        for offset, title, body in scan_fasta(raw):
+            sequence = body.translate(None, delete)
+            if args.ignore_case:
+                sequence = sequence.upper()
+            digest = blake2b(sequence, digest_size=16).digest()
+            id_ = title.split(None, 1)
+            id_ = id_[0] if id_ else b''
+            if digest not in seq_first:
+                seq_first[digest] = [len(seq_first), offset, id_, 1]
+            else:
+                seq_first[digest][3] += 1
+            buffer.append((seq_first[digest][0], before, id_))
+            if len(buffer) >= RUN_SIZE:
+                spill(buffer, runs)
+            before += 1
+        spill(buffer, runs)
+
+        log = open(args.input+'.log', 'w')
+        output = open(args.input+'.uniq', 'wb')
+        map_file = open(args.input+'.map', 'w')
+        map_file.write('Representative\tMember\n')
+        members = groupby(merge(*[read_run(i) for i in runs]),
+                          key=lambda x: x[0])
+        for (_, offset, first, count), (_, group) in zip(
+                seq_first.values(), members):
+            after += 1
+            output.write(format_fasta(*read_record(raw, offset)))
+            first = first.decode()
+            for i in group:
+                map_file.write(f'{first}\t{i[2]}\n')
+    for run in runs:
+        run.close()
+    log.write('Before\tAfter\n')
+    log.write('{}\t\t{}\n'.format(before, after))
+    print('Total {} sequences in {} format.'.format(before, 'fasta'))
+    print('{} sequences left in the file {}.uniq.'.format(after, args.input))
+    log.close()
+    output.close()
+    map_file.close()
+    return before, after
+
+
+def get_files(patterns) -> list:
+    # expand patterns if shell did not
+    files = []
+    for pattern in patterns:
+        matched = sorted(glob(pattern))
+        files.extend(matched if matched else [pattern])
+    return files
+
+
+def uniq_one(args):
+    """
+    Run one file, for Pool.
+    Return:
+        input(str): input file
+        before(int): number of sequences before
+        after(int): number of sequences after, None if failed
+    """
+    SEP = re.compile(r'[\|/\\:;~!\?@#$%^&\*+=]')
+    try:
+        if args.method == 'hash':
+            before, after = uniq_hash(args)
+        elif args.seqio:
+            before, after = uniq(args, SEP)
+        else:
+            before, after = uniq_stream(args, SEP)
+    except (OSError, ValueError) as e:
+        print(f'Failed to handle {args.input}: {e}')
+        return args.input, 0, None
+    return args.input, before, after
 
 
 def main():
@@ -88,7 +376,28 @@ def main():
     args = parse_args()
 
     SEP = re.compile(r'[\|/\\:;~!\?@#$%^&\*+=]')
-    uniq(args, SEP)
+    files = get_files(args.input)
+    # ask only once
+    if args.method != 'hash' and args.choice is None:
+        args.choice = get_choice(files[0], SEP)
+    tasks = []
+    for fasta in files:
+        task = copy(args)
+        task.input = fasta
+        tasks.append(task)
+    if len(tasks) == 1:
+        results = [uniq_one(tasks[0])]
+    else:
+        with Pool(max(1, min(args.jobs, len(tasks)))) as pool:
+            results = pool.map(uniq_one, tasks, chunksize=1)
+        failed = [i[0] for i in results if i[2] is None]
+        before = sum(i[1] for i in results)
+        after = sum(i[2] for i in results if i[2] is not None)
+        print('Handled {} files, {} failed.'.format(len(results),
+                                                   len(failed)))
+        for i in failed:
+            print('Failed:', i)
+        print('Total {} sequences, {} left.'.format(before, after))
     end = timer()
     print('Cost {:.3f} seconds.'.format(end-start))
 